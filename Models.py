@@ -1,24 +1,267 @@
 """
 Define all data models: Person, Circle, Event.
 """
+import random
 import string
 from collections import defaultdict
-from datetime import datetime
+from datetime import datetime, timezone
 from py2neo.ogm import (GraphObject, Property, Related, RelatedTo)
 
 import cypher
+import doc_cache
 
 
 class GraphError(Exception):
     pass
 
 
+class ConflictError(GraphError):
+    """A write would break a uniqueness constraint, e.g. a second Person
+    with the same email."""
+    pass
+
+
+# Neo4j status code of a write that breaks a uniqueness constraint.
+CONSTRAINT_VIOLATION = 'Neo.ClientError.Schema.ConstraintValidationFailed'
+
+
+def resolve(graph, cls, ids):
+    """Fetches the cls objects with the given IDs in one query and returns
+    them in the same order. Raises a GraphError naming every missing ID."""
+    ids = list(ids)
+    if not ids:
+        return []
+    found = {node.identity: cls.wrap(node)
+             for node in cypher.nodes_by_ids(graph, cls.__name__, set(ids))}
+    missing = [i for i in ids if i not in found]
+    if len(missing) == 1:
+        raise GraphError('%s with id %s does not exist.'
+                         % (cls.__name__, missing[0]))
+    if missing:
+        raise GraphError('%s with ids %s do not exist.' % (
+            cls.__name__, ', '.join(str(i) for i in missing)))
+    return [found[i] for i in ids]
+
+
+def parse_time(value):
+    """Parses an ISO 8601 time into the naive UTC datetime it is stored as
+    (a Neo4j LocalDateTime). Times without an offset are taken to be in UTC
+    already. Raises ValueError if value is not such a time."""
+    if isinstance(value, datetime):
+        t = value
+    else:
+        try:
+            t = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        except (AttributeError, ValueError):
+            raise ValueError('%r is not an ISO 8601 datetime.' % (value,))
+    if t.tzinfo is not None:
+        t = t.astimezone(timezone.utc).replace(tzinfo=None)
+    return t
+
+
+def parse_latlng(value):
+    """Parses an event location given as a 'lat,lng' string, a [lat, lng]
+    pair or, as older clients sent it, a list holding such a string, into
+    the {latitude, longitude} map stored as a point. None clears the
+    location. Raises ValueError if value is not such a location."""
+    if value is None:
+        return None
+    pair = value[0] if isinstance(value, list) and len(value) == 1 else value
+    if isinstance(pair, str):
+        pair = pair.split(',')
+    try:
+        lat, lng = (float(v) for v in pair)
+    except (TypeError, ValueError):
+        raise ValueError('%r is not a latitude,longitude pair.' % (value,))
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        raise ValueError('%r is out of range.' % (value,))
+    return {'latitude': lat, 'longitude': lng}
+
+
+def _events_page(matches, limit):
+    """Splits limit + 1 event page matches into the page's event IDs and the
+    position of the next page (None if this is the last page)."""
+    next_position = None
+    if len(matches) > limit:
+        last = matches[limit - 1]
+        next_position = {'start': Event._time_repr(last['start']),
+                         'id': last['id']}
+    return [m['id'] for m in matches[:limit]], next_position
+
+
+def new_version():
+    """Initial version of a new node. Neo4j reuses the IDs of deleted nodes,
+    so versions start from a random base instead of 1 to keep a replacement
+    node's (ID, version) pairs, and so its ETags and cached documents,
+    distinct from those of the node it replaces."""
+    return random.getrandbits(48)
+
+
+def _cached_docs(graph, node_ids, versions, build):
+    """Returns the documents of node_ids, in order, skipping nodes that no
+    longer exist. Documents cached at the node's version in versions (looked
+    up if None) are reused, which relies on new_version to tell a node apart
+    from an earlier node with the same ID; the rest come from build(graph, missing IDs),
+    which returns {node ID: (version, document)}, and are cached."""
+    node_ids = list(node_ids)
+    if versions is None:
+        versions = cypher.versions_of(graph, node_ids)
+    docs = {}
+    for node_id in node_ids:
+        if node_id in versions:
+            doc = doc_cache.get(node_id, versions[node_id])
+            if doc is not None:
+                docs[node_id] = doc
+    missing = [node_id for node_id in node_ids if node_id not in docs]
+    if missing:
+        for node_id, (version, doc) in build(graph, missing).items():
+            doc_cache.put(node_id, version, doc)
+            docs[node_id] = doc
+    return [docs[node_id] for node_id in node_ids if node_id in docs]
+
+
+class UnitOfWork(object):
+    """Collects every node and relationship change of one API call and
+    commits them in a single transaction, one UNWIND statement per label or
+    relationship type.
+
+    Nodes are referred to by ID, by a bound GraphObject, or by a new
+    GraphObject passed to create() earlier in the same unit of work. The
+    created and touched nodes are recorded in the change log (see
+    cypher.log_changes) in the same transaction.
+    """
+
+    def __init__(self):
+        self._created = []  # [GraphObject]
+        self._updated = defaultdict(list)  # {label: [{id, properties}]}
+        self._unrelated = defaultdict(list)  # {rel_type: [(start, end)]}
+        # {(rel_type, directed): [(start, end, properties)]}
+        self._related = defaultdict(list)
+        self._new_ids = {}  # {id(GraphObject): node ID}, filled by commit
+        self._touched = []  # nodes whose version is bumped on commit
+
+    def create(self, obj):
+        self._created.append(obj)
+
+    def update(self, label, node_id, properties):
+        self._updated[label].append({'id': node_id,
+                                     'properties': properties})
+        self.touch(node_id)
+
+    def touch(self, node):
+        """Marks an existing node as changed so its version is bumped."""
+        self._touched.append(node)
+
+    def relate(self, rel_type, start, end, properties=None, directed=True):
+        self._related[(rel_type, directed)].append(
+            (start, end, properties or {}))
+        self._touched.extend((start, end))
+
+    def unrelate(self, rel_type, start, end):
+        self._unrelated[rel_type].append((start, end))
+        self._touched.extend((start, end))
+
+    def sync_relationships(self, rel_type, node_id, current, desired,
+                           outgoing=True, directed=True):
+        """Records only the difference between the current and desired
+        relationships of node_id, both given as {other ID: properties}."""
+        for other_id in current:
+            if other_id not in desired:
+                start, end = ((node_id, other_id) if outgoing
+                              else (other_id, node_id))
+                self.unrelate(rel_type, start, end)
+        for other_id, properties in desired.items():
+            if current.get(other_id) != properties:
+                start, end = ((node_id, other_id) if outgoing
+                              else (other_id, node_id))
+                self.relate(rel_type, start, end, properties, directed)
+
+    def id_of(self, node):
+        """Returns the node ID of node, including objects created by this
+        unit of work once it has been committed."""
+        if isinstance(node, int):
+            return node
+        if id(node) in self._new_ids:
+            return self._new_ids[id(node)]
+        return node.__primaryvalue__
+
+    def _suggestion_hubs(self, rel_type):
+        """Returns the people added to and removed from each shared node of
+        a suggestion signal, for cypher.adjust_suggestions. Relationships
+        recorded by relate are new ones; sync_relationships and created
+        nodes only ever record those. A person listed twice for a hub, e.g.
+        a circle posted with a repeated member ID, counts once."""
+        symmetric = cypher.SUGGESTION_SIGNALS[rel_type][0] == 'Person'
+        hubs = defaultdict(lambda: {'added': set(), 'removed': set()})
+        changes = [('added', start, end)
+                   for (r_type, _), pairs in self._related.items()
+                   if r_type == rel_type for start, end, _ in pairs]
+        changes += [('removed', start, end)
+                    for start, end in self._unrelated.get(rel_type, ())]
+        for change, start, end in changes:
+            start, end = self.id_of(start), self.id_of(end)
+            hubs[end][change].add(start)
+            if symmetric:
+                hubs[start][change].add(end)
+        return [{'hub': hub, 'added': sorted(people['added']),
+                 'removed': sorted(people['removed'])}
+                for hub, people in hubs.items()]
+
+    def commit(self, graph):
+        """Writes everything in one transaction. Raises ConflictError if a
+        write breaks a uniqueness constraint (see schema.py)."""
+        try:
+            with cypher.transaction(graph) as tx:
+                by_label = defaultdict(list)
+                for obj in self._created:
+                    by_label[type(obj).__name__].append(obj)
+                for label, objs in by_label.items():
+                    rows = [{'key': i,
+                             'properties': dict(obj.__node__,
+                                                version=new_version())}
+                            for i, obj in enumerate(objs)]
+                    for m in cypher.create_nodes(tx, label, rows):
+                        self._new_ids[id(objs[m['key']])] = m['id']
+
+                for label, rows in self._updated.items():
+                    cypher.update_nodes(tx, label, rows)
+                for rel_type, pairs in self._unrelated.items():
+                    cypher.unrelate(tx, rel_type, [
+                        {'start': self.id_of(start), 'end': self.id_of(end)}
+                        for start, end in pairs])
+                for (rel_type, directed), pairs in self._related.items():
+                    cypher.relate(tx, rel_type, [
+                        {'start': self.id_of(start), 'end': self.id_of(end),
+                         'properties': properties}
+                        for start, end, properties in pairs], directed)
+                for rel_type in cypher.SUGGESTION_SIGNALS:
+                    cypher.adjust_suggestions(tx, rel_type,
+                                              self._suggestion_hubs(rel_type))
+                created = set(self._new_ids.values())
+                touched = set(self.id_of(node) for node in self._touched)
+                touched -= created
+                cypher.touch_nodes(tx, touched)
+                cypher.log_changes(tx, created, touched)
+        except Exception as x:
+            if getattr(x, 'code', None) != CONSTRAINT_VIOLATION:
+                raise
+            raise ConflictError(getattr(x, 'message', None) or str(x))
+        # Bind created objects only once their nodes are committed.
+        for obj in self._created:
+            obj.__node__.graph = graph
+            obj.__node__.identity = self._new_ids[id(obj)]
+        doc_cache.invalidate(touched)
+
+
 class Person(GraphObject):
     display_name = Property()
     email = Property()
     photo = Property()
 
     messaging_token = Property()
+    # Bumped on every change to the node or its relationships; see ETags in
+    # main.
+    version = Property()
 
     Knows = Related('Person', 'KNOWS')
     IsMember = RelatedTo('Circle', 'IS_MEMBER')
@@ -33,57 +276,107 @@ class Person(GraphObject):
     def from_json(cls, json, graph, push_updates=False):
         p = cls(json['display_name'], json['email'], json.get('photo'))
 
-        for p_id in json.get('People', []):
-            p2 = Person.match(graph, p_id).first()
-            if not p2:
-                raise GraphError('Person with id %s does not exist.' % p_id)
+        for p2 in resolve(graph, Person, json.get('People', [])):
             p.Knows.add(p2)
 
-        for c_id in json.get('Circles', []):
-            c = Circle.match(graph, c_id).first()
-            if not c:
-                raise GraphError('Person with id %s does not exist.' % c_id)
+        for c in resolve(graph, Circle, json.get('Circles', [])):
             p.IsMember.add(c)
 
-        for c_id, events in json.get('Events', {}).items():
-            for e_id, is_attending in events.items():
-                e = Event.match(graph, int(e_id)).first()
-                p.InvitedTo.add(e, properties={'attending': is_attending})
+        attendance = {int(e_id): is_attending
+                      for events in json.get('Events', {}).values()
+                      for e_id, is_attending in events.items()}
+        for e in resolve(graph, Event, attendance):
+            p.InvitedTo.add(e, properties={
+                'attending': attendance[e.__primaryvalue__]})
 
         if push_updates:
-            graph.push(p)
+            uow = UnitOfWork()
+            uow.create(p)
+            for p2 in p.Knows:
+                uow.relate('KNOWS', p, p2, directed=False)
+            for c in p.IsMember:
+                uow.relate('IS_MEMBER', p, c)
+            for e in p.InvitedTo:
+                uow.relate('INVITED_TO', p, e,
+                           {'attending': p.InvitedTo.get(e, 'attending')})
+            uow.commit(graph)
 
         return p
 
+    @classmethod
+    def by_email(cls, graph, email):
+        """Returns the Person with the given email, or None."""
+        node = cypher.person_by_email(graph, email.lower())
+        return cls.wrap(node) if node is not None else None
+
     def set_messaging_token(self, graph, token):
         if not token:
             return
         self.messaging_token = token
         graph.push(self)
 
-    def update_to(self, graph, other_person):
+    def update_to(self, graph, other_person, uow=None):
+        """Updates self to match other_person. Changes are recorded in uow
+        if given (the caller commits it), else committed right away."""
         self.display_name = other_person.display_name
         self.email = other_person.email
         self.photo = other_person.photo
 
-        self.Knows.clear()
-        for p in other_person.Knows:
-            self.Knows.add(p)
-
-        self.IsMember.clear()
-        for c in other_person.IsMember:
-            self.IsMember.add(c)
-
-        self.InvitedTo.clear()
-        for e in other_person.InvitedTo:
-            is_attending = other_person.InvitedTo.get(e, 'attending')
-            self.InvitedTo.add(e, properties={'attending': is_attending})
-
-        graph.push(self)
+        p_id = self.__primaryvalue__
+        current = cypher.person_relationships(graph, p_id)
+        own_uow = uow is None
+        if own_uow:
+            uow = UnitOfWork()
+        uow.update('Person', p_id, {
+            'display_name': self.display_name,
+            'email': self.email,
+            'photo': self.photo
+        })
+        uow.sync_relationships(
+            'KNOWS', p_id,
+            {k_id: {} for k_id in current['knows']},
+            {p.__primaryvalue__: {} for p in other_person.Knows},
+            directed=False)
+        uow.sync_relationships(
+            'IS_MEMBER', p_id,
+            {c_id: {} for c_id in current['circles']},
+            {c.__primaryvalue__: {} for c in other_person.IsMember})
+        uow.sync_relationships(
+            'INVITED_TO', p_id,
+            {e_id: {'attending': is_attending}
+             for e_id, is_attending in current['events']},
+            {e.__primaryvalue__:
+             {'attending': other_person.InvitedTo.get(e, 'attending')}
+             for e in other_person.InvitedTo})
+        if own_uow:
+            uow.commit(graph)
         return self
 
     def delete(self, graph):
-        cypher.delete_node(self, graph)
+        """Deletes the person. Their friends and circles lose them first, so
+        suggestion scores stay as a rebuild would compute them."""
+        p_id = self.__primaryvalue__
+        with cypher.transaction(graph) as tx:
+            cypher.drop_suggestion_hub(tx, 'KNOWS', p_id)
+            current = cypher.person_relationships(tx, p_id)
+            if current:
+                for rel_type, hub_ids in (('KNOWS', current['knows']),
+                                          ('IS_MEMBER', current['circles'])):
+                    cypher.adjust_suggestions(
+                        tx, rel_type, [{'hub': hub, 'added': [],
+                                        'removed': [p_id]}
+                                       for hub in sorted(set(hub_ids))])
+            return cypher.delete_node(self, tx)
+
+    @staticmethod
+    def suggestions_for(graph, person_id, limit):
+        """Returns up to limit people the person may know, best first, as
+        limited representations with their mutual_friends and
+        shared_circles counts."""
+        return [dict(Person.wrap(m['person']).json_repr_lim(),
+                     mutual_friends=m['mutual_friends'],
+                     shared_circles=m['shared_circles'])
+                for m in cypher.suggestions_for(graph, person_id, limit)]
 
     @staticmethod
     def attendance_of(graph, person_id):
@@ -96,6 +389,50 @@ class Person(GraphObject):
             action_entity='ID(dest), rel.attending')
         return {m['ID(dest)']: m['rel.attending'] for m in matches}
 
+    @staticmethod
+    def feed_of(graph, person_id, start, end):
+        """Returns the person's home feed: their circles with member counts
+        and their events starting in [start, end), soonest first, with
+        attendance."""
+        feed = cypher.person_feed(graph, person_id, start, end)
+        if feed is None:
+            raise GraphError('Person with id %s does not exist.' % person_id)
+        for e in feed['events']:
+            e['latlng'] = Event._latlng_repr(e['latlng'])
+            e['start_datetime'] = Event._time_repr(e['start_datetime'])
+            e['end_datetime'] = Event._time_repr(e['end_datetime'])
+        return {'Circles': feed['circles'], 'Events': feed['events']}
+
+    @staticmethod
+    def circles_page_of(graph, person_id, limit, position):
+        """Returns up to limit of the person's circle IDs after the cursor
+        position, and the position of the next page (None if last)."""
+        ids = cypher.person_circles_page(graph, person_id,
+                                         position.get('id', -1), limit + 1)
+        return ids[:limit], ({'id': ids[limit - 1]} if len(ids) > limit
+                             else None)
+
+    @staticmethod
+    def people_page_of(graph, person_id, limit, position):
+        """Returns up to limit of the people the person knows after the
+        cursor position, and the position of the next page (None if last)."""
+        nodes = cypher.person_people_page(graph, person_id,
+                                          position.get('id', -1), limit + 1)
+        people = [Person.wrap(n) for n in nodes[:limit]]
+        return people, ({'id': nodes[limit - 1].identity}
+                        if len(nodes) > limit else None)
+
+    @staticmethod
+    def events_page_of(graph, person_id, limit, position, since=None,
+                       until=None):
+        """Returns up to limit of the person's event IDs in start time order
+        after the cursor position, and the position of the next page. Only
+        events starting in [since, until) (ISO 8601, None for no bound) are
+        considered."""
+        return _events_page(cypher.person_events_page(
+            graph, person_id, position.get('start'), position.get('id', -1),
+            limit + 1, since, until), limit)
+
     def json_repr(self, graph):
         events = defaultdict(dict)
         for e in self.InvitedTo:
@@ -111,6 +448,15 @@ class Person(GraphObject):
             'Events': events
         }
 
+    @staticmethod
+    def json_repr_lim_many(graph, person_ids):
+        """Limited representations of the people in person_ids, fetched with
+        a single query. People that do not exist are skipped."""
+        people = {node.identity: Person.wrap(node) for node in
+                  cypher.nodes_by_ids(graph, 'Person', set(person_ids))}
+        return [people[p_id].json_repr_lim() for p_id in person_ids
+                if p_id in people]
+
     def json_repr_lim(self):
         return{
             'id': self.__primaryvalue__,
@@ -125,6 +471,7 @@ class Circle(GraphObject):
     owner_id = Property()
     members_can_add = Property()
     members_can_ping = Property()
+    version = Property()
 
     Scheduled = RelatedTo('Event', 'SCHEDULED')
 
@@ -144,34 +491,31 @@ class Circle(GraphObject):
                 json.get('members_can_ping', False))
 
         # Add MEMBERS to circle (safe if no 'People' field).
-        for p_id in json.get('People', []):
-            p = Person.match(graph, p_id).first()
-            if not p:
-                raise GraphError('Person with id %s does not exist.' % p_id)
-            c.members.append(p)
+        c.members.extend(resolve(graph, Person, json.get('People', [])))
 
         # Add EVENTS to circle (safe if no 'Events' field).
-        events = []
-        for e_id in json.get('Events', []):
-            e = Event.match(graph, e_id).first()
-            if not e:
-                raise GraphError('Event with id %s does not exist.' % e_id)
+        for e in resolve(graph, Event, json.get('Events', [])):
             c.Scheduled.add(e)
 
         # Push all updates to remote graph.
         if push_updates:
+            uow = UnitOfWork()
+            uow.create(c)
             for p in c.members:
-                p.IsMember.add(c)
-                graph.push(p)
-            graph.push(c)
+                uow.relate('IS_MEMBER', p, c)
+            for e in c.Scheduled:
+                uow.relate('SCHEDULED', c, e)
+            uow.commit(graph)
 
         return c
 
     def delete(self, graph):
-        # Delete all related events first.
-        for e in self.Scheduled:
-            cypher.delete_node(e, graph)
-        cypher.delete_node(self, graph)
+        """Deletes the circle and its scheduled events in one statement.
+        Returns the nodes_deleted and relationships_deleted counts."""
+        with cypher.transaction(graph) as tx:
+            cypher.drop_suggestion_hub(tx, 'IS_MEMBER', self.__primaryvalue__)
+            return cypher.delete_node(self, tx,
+                                      cascade=('SCHEDULED', 'Event'))
 
     @staticmethod
     def members_of(graph, circle_id):
@@ -180,42 +524,100 @@ class Circle(GraphObject):
                                          src_type='Circle',
                                          rel_type='IS_MEMBER',
                                          dest_type='Person',
-                                         action_entity='ID(dest)')
-        return [Person.match(graph, m['ID(dest)']).first() for m in matches]
+                                         action_entity='DISTINCT dest')
+        return [Person.wrap(m['dest']) for m in matches]
+
+    @staticmethod
+    def projection_of(graph, circle_id):
+        """Returns the circle's properties plus member and event IDs, all
+        fetched in one query."""
+        match = cypher.circle_projection(graph, circle_id)
+        if not match:
+            raise GraphError('Circle with id %s does not exist.' % circle_id)
+        return {
+            'properties': dict(match['circle']),
+            'People': match['member_ids'],
+            'Events': match['event_ids']
+        }
 
-    def update_to(self, graph, to_circle):
-        """Updates self to have same properties as to_circle."""
+    def update_to(self, graph, to_circle, uow=None):
+        """Updates self to have same properties as to_circle. Changes are
+        recorded in uow if given, else committed right away."""
         self.display_name = to_circle.display_name
         self.description = to_circle.description
         self.owner_id = to_circle.owner_id
         self.members_can_add = to_circle.members_can_add
         self.members_can_ping = to_circle.members_can_ping
 
+        c_id = self.__primaryvalue__
+        current = Circle.projection_of(graph, c_id)
+        own_uow = uow is None
+        if own_uow:
+            uow = UnitOfWork()
+        uow.update('Circle', c_id, {
+            'display_name': self.display_name,
+            'description': self.description,
+            'owner_id': self.owner_id,
+            'members_can_add': self.members_can_add,
+            'members_can_ping': self.members_can_ping
+        })
         # Update members.
-        cypher.delete_relationships_from(graph, self.__primaryvalue__,
-                                         'Circle', 'IS_MEMBER', 'Person')
-        self.Scheduled.clear()
-        for p in to_circle.members:
-            p.IsMember.add(self)
-            graph.push(p)
-        for e in to_circle.Scheduled:
-            self.Scheduled.add(e)
-        graph.push(self)
+        uow.sync_relationships(
+            'IS_MEMBER', c_id,
+            {p_id: {} for p_id in current['People']},
+            {p.__primaryvalue__: {} for p in to_circle.members},
+            outgoing=False)
+        uow.sync_relationships(
+            'SCHEDULED', c_id,
+            {e_id: {} for e_id in current['Events']},
+            {e.__primaryvalue__: {} for e in to_circle.Scheduled})
+        if current['properties'].get('display_name') != self.display_name:
+            # Events show their circle's name.
+            for e_id in current['Events']:
+                uow.touch(e_id)
+        if own_uow:
+            uow.commit(graph)
 
         return self
 
+    @staticmethod
+    def events_page_of(graph, circle_id, limit, position, since=None,
+                       until=None):
+        """Returns up to limit of the circle's event IDs in start time order
+        after the cursor position, and the position of the next page. Only
+        events starting in [since, until) (ISO 8601, None for no bound) are
+        considered."""
+        return _events_page(cypher.circle_events_page(
+            graph, circle_id, position.get('start'), position.get('id', -1),
+            limit + 1, since, until), limit)
+
     def json_repr(self, graph):
-        members = Circle.members_of(graph, self.__primaryvalue__)
-        return {
-            'id': self.__primaryvalue__,
-            'owner_id': self.owner_id,
-            'members_can_add': self.members_can_add,
-            'members_can_ping': self.members_can_ping,
-            'display_name': self.display_name,
-            'description': self.description,
-            'People': [p.__primaryvalue__ for p in members],
-            'Events': [e.__primaryvalue__ for e in list(self.Scheduled)]
-        }
+        c_id = self.__primaryvalue__
+        return Circle.json_repr_many(graph, [c_id], {c_id: self.version})[0]
+
+    @staticmethod
+    def json_repr_many(graph, circle_ids, versions=None):
+        """Serializes every circle in circle_ids, from the document cache
+        where possible and else with a single query. Circles that no longer
+        exist are skipped. versions ({ID: version}) saves looking them up."""
+        return _cached_docs(graph, circle_ids, versions, Circle._build_docs)
+
+    @staticmethod
+    def _build_docs(graph, circle_ids):
+        docs = {}
+        for m in cypher.circles_projection(graph, circle_ids):
+            c = m['circle']
+            docs[c.identity] = c['version'], {
+                'id': c.identity,
+                'owner_id': c['owner_id'],
+                'members_can_add': c['members_can_add'],
+                'members_can_ping': c['members_can_ping'],
+                'display_name': c['display_name'],
+                'description': c['description'],
+                'People': m['member_ids'],
+                'Events': m['event_ids']
+            }
+        return docs
 
 
 class Event(GraphObject):
@@ -228,6 +630,7 @@ class Event(GraphObject):
     created_at = Property()
     owner_id = Property()
     circle_id = Property()
+    version = Property()
 
     def __init__(self, display_name, description, location, latlng,
                  start_datetime, end_datetime, owner_id, circle_id):
@@ -237,7 +640,7 @@ class Event(GraphObject):
         self.latlng = latlng
         self.start_datetime = start_datetime
         self.end_datetime = end_datetime
-        self.created_at = datetime.utcnow().replace(microsecond=0).isoformat()
+        self.created_at = datetime.utcnow().replace(microsecond=0)
         self.owner_id = owner_id
         self.circle_id = circle_id
 
@@ -248,64 +651,88 @@ class Event(GraphObject):
     def from_json(cls, json, graph, push_updates=False):
         # Specified Circle must exist.
         c_id = json['Circle']
-        c = Circle.match(graph, c_id).first()
-        if not c:
-            raise GraphError('Event with id %s does not exist.' % c_id)
-
+        c = resolve(graph, Circle, [c_id])[0]
+
+        try:
+            latlng = parse_latlng(json['latlng'])
+            start = parse_time(json['start_datetime'])
+            end = parse_time(json['end_datetime'])
+        except ValueError as x:
+            raise GraphError(str(x))
         e = cls(json['display_name'], json.get('description'),
-                json['location'], json['latlng'], json['start_datetime'],
-                json['end_datetime'], json['owner_id'], c_id)
+                json['location'], latlng, start, end, json['owner_id'], c_id)
         e.circle = c
 
         # Add invitees to circle (safe if no 'People' field).
-        for p_id, is_attending in json.get('People', {}).items():
-            p_id = int(p_id)
-            p = Person.match(graph, p_id).first()
-            if not p:
-                raise GraphError('Person with id %s does not exist.' % p_id)
-            e.invitees.append((p, is_attending))
+        attendance = {int(p_id): is_attending
+                      for p_id, is_attending in json.get('People', {}).items()}
+        for p in resolve(graph, Person, attendance):
+            e.invitees.append((p, attendance[p.__primaryvalue__]))
 
         # Push all related updates to remote graph.
         if push_updates:
+            uow = UnitOfWork()
+            uow.create(e)
             for p, is_attending in e.invitees:
-                p.InvitedTo.add(e, {'attending': is_attending})
-                graph.push(p)
-            c.Scheduled.add(e)
-            graph.push(c)
-            graph.push(e)
+                uow.relate('INVITED_TO', p, e, {'attending': is_attending})
+            uow.relate('SCHEDULED', c, e)
+            uow.commit(graph)
 
         return e
 
-    def update_to(self, graph, to_event):
-        """Updates self to have same properties as to_event."""
+    def update_to(self, graph, to_event, uow=None):
+        """Updates self to have same properties as to_event. Changes are
+        recorded in uow if given, else committed right away."""
         self.display_name = to_event.display_name
         self.description = to_event.description
         self.location = to_event.location
-        self.latlng = to_event.latlng,
+        self.latlng = to_event.latlng
         self.start_datetime = to_event.start_datetime
         self.end_datetime = to_event.end_datetime
         self.created_at = to_event.created_at
         self.owner_id = to_event.owner_id
         self.circle_id = to_event.circle_id
 
+        e_id = self.__primaryvalue__
+        current = cypher.events_projection(graph, [e_id])[0]
+        own_uow = uow is None
+        if own_uow:
+            uow = UnitOfWork()
+        uow.update('Event', e_id, {
+            'display_name': self.display_name,
+            'description': self.description,
+            'location': self.location,
+            'latlng': self.latlng,
+            'start_datetime': self.start_datetime,
+            'end_datetime': self.end_datetime,
+            'created_at': self.created_at,
+            'owner_id': self.owner_id,
+            'circle_id': self.circle_id
+        })
         # Update members.
-        cypher.delete_relationships_from(graph, self.__primaryvalue__,
-                                         'Event', 'INVITED_TO', 'Person')
+        uow.sync_relationships(
+            'INVITED_TO', e_id,
+            {p_id: {'attending': is_attending}
+             for p_id, is_attending in current['invitees']},
+            {p.__primaryvalue__: {'attending': is_attending}
+             for p, is_attending in to_event.invitees},
+            outgoing=False)
         # Update associated circle.
-        cypher.delete_relationships_from(graph, self.__primaryvalue__,
-                                         'Event', 'SCHEDULED', 'Circle')
-
-        for p, is_attending in to_event.invitees:
-            p.InvitedTo.add(self, {'attending': is_attending})
-            graph.push(p)
-        to_event.circle.Scheduled.add(self)
-        graph.push(to_event.circle)
-
-        graph.push(self)
+        uow.sync_relationships(
+            'SCHEDULED', e_id,
+            {c_id: {} for c_id, _ in current['circles']},
+            {to_event.circle.__primaryvalue__: {}},
+            outgoing=False)
+        if current['event']['circle_id'] != self.circle_id:
+            # Invitees list their events by circle.
+            for p_id, _ in current['invitees']:
+                uow.touch(p_id)
+        if own_uow:
+            uow.commit(graph)
         return self
 
     def delete(self, graph):
-        cypher.delete_node(self, graph)
+        return cypher.delete_node(self, graph)
 
     @staticmethod
     def invitees_of(graph, event_id):
@@ -316,9 +743,8 @@ class Event(GraphObject):
             rel_type='INVITED_TO',
             dest_type='Person',
             action_entity='ID(dest), rel.attending')
-        return [(Person.match(graph,
-                              m['ID(dest)']).first(), m['rel.attending'])
-                for m in matches]
+        people = resolve(graph, Person, [m['ID(dest)'] for m in matches])
+        return [(p, m['rel.attending']) for p, m in zip(people, matches)]
 
     @staticmethod
     def circles_of(graph, event_id):
@@ -328,28 +754,73 @@ class Event(GraphObject):
                                          rel_type='SCHEDULED',
                                          dest_type='Circle',
                                          action_entity='ID(dest)')
-        return [Circle.match(graph, m['ID(dest)']).first() for m in matches]
+        return resolve(graph, Circle, [m['ID(dest)'] for m in matches])
 
     def json_repr(self, graph):
-        invitees = Event.invitees_of(graph, self.__primaryvalue__)
-        circles = Event.circles_of(graph, self.__primaryvalue__)
-        if isinstance(self.latlng, str):
-            latlng = self.latlng
-        elif isinstance(self.latlng, list):
-            latlng = self.latlng[0]
-        return {
-            'id': self.__primaryvalue__,
-            'display_name': self.display_name,
-            'description': self.description,
-            'location': self.location,
-            'latlng': latlng,
-            'start_datetime': self.start_datetime,
-            'end_datetime': self.end_datetime,
-            'created_at': self.created_at,
-            'owner_id': self.owner_id,
-            'Circle': circles[0].__primaryvalue__,
-            'circle_name': circles[0].display_name,
-            'People':
-            {p.__primaryvalue__: attending
-             for p, attending in invitees}
-        }
+        e_id = self.__primaryvalue__
+        return Event.json_repr_many(graph, [e_id], {e_id: self.version})[0]
+
+    @staticmethod
+    def json_repr_many(graph, event_ids, versions=None):
+        """Serializes every event in event_ids, from the document cache where
+        possible and else with a single query. Events that no longer exist
+        are skipped. versions ({ID: version}) saves looking them up."""
+        return _cached_docs(graph, event_ids, versions, Event._build_docs)
+
+    @staticmethod
+    def nearby(graph, person_id, center, radius, limit, since=None,
+               until=None):
+        """Serializes up to limit events in the person's circles within
+        radius meters of center, nearest first, each with its distance."""
+        matches = cypher.nearby_events(graph, person_id, center, radius,
+                                       limit, since, until)
+        docs = Event.json_repr_many(graph, [m['id'] for m in matches],
+                                    {m['id']: m['version'] for m in matches})
+        distances = {m['id']: m['distance'] for m in matches}
+        return [dict(doc, distance=round(distances[doc['id']]))
+                for doc in docs]
+
+    @staticmethod
+    def _build_docs(graph, event_ids):
+        docs = {}
+        for m in cypher.events_projection(graph, event_ids):
+            e = m['event']
+            circle_id, circle_name = (m['circles'][0] if m['circles']
+                                      else (None, None))
+            docs[e.identity] = e['version'], {
+                'id': e.identity,
+                'display_name': e['display_name'],
+                'description': e['description'],
+                'location': e['location'],
+                'latlng': Event._latlng_repr(e['latlng']),
+                'start_datetime': Event._time_repr(e['start_datetime']),
+                'end_datetime': Event._time_repr(e['end_datetime']),
+                'created_at': Event._time_repr(e['created_at']),
+                'owner_id': e['owner_id'],
+                'Circle': circle_id,
+                'circle_name': circle_name,
+                'People': {p_id: attending
+                           for p_id, attending in m['invitees']}
+            }
+        return docs
+
+    @staticmethod
+    def _time_repr(value):
+        """ISO 8601 string for a stored time: a Neo4j temporal value, a
+        datetime or, on nodes from before the event_times migration, the
+        original string."""
+        if hasattr(value, 'to_native'):
+            value = value.to_native()
+        if isinstance(value, datetime):
+            return value.isoformat()
+        return value
+
+    @staticmethod
+    def _latlng_repr(latlng):
+        """'lat,lng' string for a stored location: a point or, on events from
+        before the event_locations migration, what the client sent."""
+        if hasattr(latlng, 'latitude'):
+            return '%s,%s' % (latlng.latitude, latlng.longitude)
+        if isinstance(latlng, list):
+            return latlng[0]
+        return latlng
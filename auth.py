@@ -1,21 +1,147 @@
 """
 All authentication convenience functions for connecting to Neo4j and FCM.
 """
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from threading import Lock
+
 from google.cloud import datastore
+from py2neo import Graph
+from pyfcm import FCMNotification
 
+SETTINGS_KEYS = ('NEO4J_HOST', 'NEO4J_USERNAME', 'NEO4J_PASSWORD',
+                 'FCM_API_KEY')
+# Optional JSON file of settings, mainly for local development.
+SETTINGS_FILE_ENV = 'CIRCLES_SETTINGS_FILE'
+
+_settings = None
+_settings_lock = Lock()
+
+
+def settings():
+    """Gets the server's settings, loading them at most once per process.
+    Values come from the GaeEnvSettings Datastore entity, overridden by the
+    JSON file named in $CIRCLES_SETTINGS_FILE and then by environment
+    variables of the same name. Datastore is not queried at all when the
+    overrides supply every key."""
+    global _settings
+    if _settings is None:
+        with _settings_lock:
+            if _settings is None:
+                _settings = _load_settings()
+    return _settings
+
+
+def _load_settings():
+    overrides = {}
+    path = os.environ.get(SETTINGS_FILE_ENV)
+    if path:
+        with open(path) as f:
+            overrides.update(json.load(f))
+    overrides.update({k: os.environ[k] for k in SETTINGS_KEYS
+                      if k in os.environ})
+    if all(k in overrides for k in SETTINGS_KEYS):
+        return overrides
 
-def neo4j_creds():
-    """Gets the host, username, and password from Datastore."""
     # Get auth variables from cloud datastore.
     datastore_client = datastore.Client()
     query = datastore_client.query(kind='GaeEnvSettings')
-    env_vars = list(query.fetch())[0]
+    env_vars = dict(list(query.fetch(limit=1))[0])
+    env_vars.update(overrides)
+    return env_vars
+
+
+def neo4j_creds():
+    """Gets the host, username, and password."""
+    env_vars = settings()
     return env_vars['NEO4J_HOST'], env_vars['NEO4J_USERNAME'], env_vars['NEO4J_PASSWORD']
 
 
 def fcm_creds():
     """Google Firestore Cloud Messaging auth."""
-    datastore_client = datastore.Client()
-    query = datastore_client.query(kind='GaeEnvSettings')
-    env_vars = list(query.fetch())[0]
-    return env_vars['FCM_API_KEY']
+    return settings()['FCM_API_KEY']
+
+
+def connect_graph(max_connections=None):
+    """Connects to Neo4j. max_connections caps py2neo's own connection
+    pool; py2neo's default is used if None."""
+    host, username, password = neo4j_creds()
+    settings = {'max_connections': max_connections} if max_connections else {}
+    return Graph(host=host, username=username,
+                 password=password, secure=True, **settings)
+
+
+def connect_fcm():
+    return FCMNotification(api_key=fcm_creds())
+
+
+class Lazy(object):
+    """Proxy for a client that is only built, by calling factory, the first
+    time one of its attributes is used."""
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._client = None
+        self._lock = Lock()
+
+    def get(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self._factory()
+        return self._client
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+
+class TokenCache(object):
+    """Bounded LRU cache mapping verified ID tokens to the requesting
+    Person's ID. Tokens are keyed by hash and expire at their exp claim."""
+
+    def __init__(self, max_size=4096, clock=time.time):
+        self.max_size = max_size
+        self.clock = clock
+        self._entries = OrderedDict()  # {token hash: (person_id, exp)}
+        self._lock = Lock()
+
+    @staticmethod
+    def _key(token):
+        return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+    def get(self, token):
+        """Returns the cached Person ID for token, or None."""
+        if not token:
+            return None
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            person_id, exp = entry
+            if exp <= self.clock():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return person_id
+
+    def put(self, token, person_id, exp):
+        if not token or exp <= self.clock():
+            return
+        key = self._key(token)
+        with self._lock:
+            self._entries[key] = (person_id, exp)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate_person(self, person_id):
+        """Drops every cached token that resolves to person_id."""
+        with self._lock:
+            stale = [key for key, (p_id, _) in self._entries.items()
+                     if p_id == person_id]
+            for key in stale:
+                del self._entries[key]
@@ -0,0 +1,41 @@
+"""
+Permission checks that test a single relationship instead of loading all of
+the requester's circles or events.
+
+Answers are memoized for the current request between start_request and
+finish_request, which hooks in main call around every request. Outside a
+request every check goes to the graph.
+"""
+import threading
+
+import cypher
+
+_local = threading.local()
+
+
+def start_request():
+    _local.memo = {}
+
+
+def finish_request():
+    _local.memo = None
+
+
+def _memoized(check, graph, person_id, other_id):
+    memo = getattr(_local, 'memo', None)
+    if memo is None:
+        return check(graph, person_id, other_id)
+    key = (check.__name__, person_id, other_id)
+    if key not in memo:
+        memo[key] = check(graph, person_id, other_id)
+    return memo[key]
+
+
+def is_member(graph, person_id, circle_id):
+    """Whether the person is a member of the circle."""
+    return _memoized(cypher.is_member, graph, person_id, circle_id)
+
+
+def is_invited(graph, person_id, event_id):
+    """Whether the person is invited to the event."""
+    return _memoized(cypher.is_invited, graph, person_id, event_id)
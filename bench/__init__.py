@@ -0,0 +1,3 @@
+"""
+Offline benchmarks for the Circles server. See bench/run.py.
+"""
@@ -0,0 +1,810 @@
+"""
+In-memory stand-in for py2neo's Graph, covering what Models and cypher use.
+
+Registered queries (see cypher.register) are answered by the `_q_<name>`
+methods below, keyed by the query's registered name. Node lookups generated
+by GraphObject.match, relationship loads for Related attributes and
+graph.push of GraphObjects are emulated directly. Anything else raises
+NotImplementedError naming the query, so gaps show up loudly rather than as
+wrong numbers.
+
+Every call that would be a round trip to Neo4j is counted in `query_count`
+and can be slowed down by `latency` seconds to model network cost.
+"""
+import math
+import re
+import time
+from collections import defaultdict, namedtuple
+from datetime import datetime
+from threading import RLock
+
+from py2neo import Node, Relationship
+from py2neo.ogm import GraphObject, Related, RelatedFrom, RelatedTo
+
+import cypher
+
+_NODE_MATCH = re.compile(r'^\s*MATCH \(_((?::`?\w+`?)*)\)\s*'
+                         r'(?:WHERE id\(_\) = (\d+)\s*)?RETURN _\b', re.I)
+
+
+# Change log relationships (see cypher.log_changes).
+LOG_RELS = ('HAS_CHANGE', 'SEES_CHANGE')
+
+# Stands in for the driver's WGS-84 point values.
+FakePoint = namedtuple('FakePoint', ['latitude', 'longitude'])
+
+EARTH_RADIUS = 6378140.0  # meters, as Neo4j's distance() uses
+
+
+def _point(value):
+    return FakePoint(**value) if value is not None else None
+
+
+def _distance(a, b):
+    """Haversine distance in meters between two points."""
+    lat1, lat2 = math.radians(a.latitude), math.radians(b.latitude)
+    dlat = lat2 - lat1
+    dlng = math.radians(b.longitude - a.longitude)
+    h = (math.sin(dlat / 2) ** 2 +
+         math.cos(lat1) * math.cos(lat2) * math.sin(dlng / 2) ** 2)
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(h))
+
+
+def _time(value):
+    """Compares stored times and query parameters the way Neo4j compares
+    LocalDateTimes; strings are parsed as an unmigrated node would be."""
+    if isinstance(value, str):
+        return datetime.fromisoformat(value)
+    return value
+
+
+class FakeRecord(tuple):
+    """A result row that can be indexed by position or column name."""
+
+    def __new__(cls, keys, values):
+        record = tuple.__new__(cls, values)
+        record.keys = tuple(keys)
+        return record
+
+    def __getitem__(self, item):
+        if isinstance(item, str):
+            return tuple.__getitem__(self, self.keys.index(item))
+        return tuple.__getitem__(self, item)
+
+    def data(self):
+        return dict(zip(self.keys, self))
+
+
+class FakeCursor(object):
+
+    def __init__(self, rows=(), stats=None):
+        self._records = [FakeRecord(row.keys(), row.values()) for row in rows]
+        self._stats = stats or {}
+
+    def __iter__(self):
+        return iter(self._records)
+
+    def data(self):
+        return [r.data() for r in self._records]
+
+    def evaluate(self, field=0):
+        return self._records[0][field] if self._records else None
+
+    def stats(self):
+        return dict(self._stats)
+
+
+class FakeSchema(object):
+
+    def __init__(self):
+        self.indexes = set()
+        self.constraints = set()
+
+    def get_indexes(self, label):
+        return [keys for l, keys in self.indexes if l == label]
+
+    def get_uniqueness_constraints(self, label):
+        return [key for l, key in self.constraints if l == label]
+
+    def create_index(self, label, *property_keys):
+        self.indexes.add((label, property_keys))
+
+    def create_uniqueness_constraint(self, label, property_key):
+        self.constraints.add((label, property_key))
+
+
+class FakeTransaction(object):
+    """Runs statements straight against the graph, and puts back a snapshot
+    of the graph taken at begin() on rollback."""
+
+    def __init__(self, graph):
+        self.graph = graph
+        self._snapshot = graph.snapshot()
+
+    def run(self, cypher_text, parameters=None, **kwparameters):
+        return self.graph.run(cypher_text, parameters, **kwparameters)
+
+    def evaluate(self, cypher_text, parameters=None, **kwparameters):
+        return self.run(cypher_text, parameters, **kwparameters).evaluate()
+
+    def commit(self):
+        self._snapshot = None
+
+    def rollback(self):
+        if self._snapshot is not None:
+            self.graph.restore(self._snapshot)
+            self._snapshot = None
+
+
+class FakeGraph(object):
+    database = 'fake'
+    name = 'data'
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.query_count = 0
+        self.schema = FakeSchema()
+        self._lock = RLock()
+        self._next_id = 1
+        self._nodes = {}  # {id: (frozenset(labels), {properties})}
+        self._rels = {}  # {id: (type, start id, end id, {properties})}
+        self._adjacent = {}  # {node id: set(rel ids)}
+
+    """
+    Store primitives, also used to seed synthetic data.
+    """
+
+    def create_node(self, label, **properties):
+        with self._lock:
+            node_id = self._take_id()
+            self._nodes[node_id] = (frozenset([label]), dict(properties))
+            self._adjacent[node_id] = set()
+            return node_id
+
+    def create_rel(self, start_id, rel_type, end_id, **properties):
+        with self._lock:
+            rel_id = self._take_id()
+            self._rels[rel_id] = (rel_type, start_id, end_id,
+                                  dict(properties))
+            self._adjacent[start_id].add(rel_id)
+            self._adjacent[end_id].add(rel_id)
+            return rel_id
+
+    def delete_rel(self, rel_id):
+        rel_type, start_id, end_id, _ = self._rels.pop(rel_id)
+        self._adjacent[start_id].discard(rel_id)
+        self._adjacent[end_id].discard(rel_id)
+
+    def delete_node(self, node_id):
+        if self._adjacent.get(node_id):
+            raise ValueError('Node %s still has relationships.' % node_id)
+        self._nodes.pop(node_id, None)
+        self._adjacent.pop(node_id, None)
+
+    def snapshot(self):
+        with self._lock:
+            return (self._next_id,
+                    {n: (labels, dict(props))
+                     for n, (labels, props) in self._nodes.items()},
+                    {r: (t, a, b, dict(props))
+                     for r, (t, a, b, props) in self._rels.items()},
+                    {n: set(rels) for n, rels in self._adjacent.items()})
+
+    def restore(self, snapshot):
+        with self._lock:
+            self._next_id, self._nodes, self._rels, self._adjacent = snapshot
+
+    def _take_id(self):
+        self._next_id += 1
+        return self._next_id - 1
+
+    def _has_label(self, node_id, label):
+        return node_id in self._nodes and (
+            not label or label in self._nodes[node_id][0])
+
+    def properties(self, node_id):
+        return self._nodes[node_id][1]
+
+    def _node(self, node_id):
+        """Returns a fresh py2neo Node bound to this graph."""
+        labels, properties = self._nodes[node_id]
+        node = Node(*labels, **properties)
+        node.graph = self
+        node.identity = node_id
+        return node
+
+    def _hops(self, node_id, rel_type=None, label=None, direction=0):
+        """Yields (rel id, neighbour id) pairs. direction is 1 for outgoing,
+        -1 for incoming and 0 for either."""
+        for rel_id in sorted(self._adjacent.get(node_id, ())):
+            r_type, start_id, end_id, _ = self._rels[rel_id]
+            if rel_type and r_type != rel_type:
+                continue
+            if start_id == node_id and direction >= 0:
+                other = end_id
+            elif end_id == node_id and direction <= 0:
+                other = start_id
+            else:
+                continue
+            if self._has_label(other, label):
+                yield rel_id, other
+
+    """
+    py2neo Graph API.
+    """
+
+    def run(self, cypher_text, parameters=None, **kwparameters):
+        params = dict(parameters or {}, **kwparameters)
+        self._tick()
+        with self._lock:
+            query = cypher.lookup(cypher_text)
+            if query is not None:
+                return self._run_registered(query.name, params)
+            match = _NODE_MATCH.match(cypher_text)
+            if match:
+                return self._run_node_match(*match.groups())
+        raise NotImplementedError('FakeGraph cannot run: %s' % cypher_text)
+
+    def evaluate(self, cypher_text, parameters=None, **kwparameters):
+        return self.run(cypher_text, parameters, **kwparameters).evaluate()
+
+    def match(self, nodes=None, r_type=None, limit=None):
+        """Relationship lookup used to load Related attributes."""
+        self._tick()
+        with self._lock:
+            if isinstance(nodes, (set, frozenset)):
+                start, end, direction = next(iter(nodes)), None, 0
+            else:
+                start, end = (tuple(nodes or ()) + (None, None))[:2]
+                direction = 1
+            if start is None:
+                start, end, direction = end, None, -1
+            rels = []
+            for rel_id, other in self._hops(start.identity, r_type,
+                                            direction=direction):
+                if end is not None and other != end.identity:
+                    continue
+                rel_type, start_id, end_id, props = self._rels[rel_id]
+                rels.append(Relationship(self._node(start_id), rel_type,
+                                         self._node(end_id), **props))
+            return rels[:limit] if limit else rels
+
+    def begin(self, autocommit=False):
+        return FakeTransaction(self)
+
+    def push(self, subgraph):
+        if not isinstance(subgraph, GraphObject):
+            raise NotImplementedError('FakeGraph can only push GraphObjects.')
+        self._tick()
+        with self._lock:
+            self._push_object(subgraph)
+
+    def _tick(self):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.query_count += 1
+
+    def _push_object(self, obj):
+        node = obj.__node__
+        if node.graph is not self or node.identity is None:
+            labels = set(node.labels) or {type(obj).__primarylabel__}
+            node.identity = self.create_node(labels.pop(), **dict(node))
+            node.graph = self
+        else:
+            labels, _ = self._nodes[node.identity]
+            self._nodes[node.identity] = (labels, dict(node))
+
+        for klass in type(obj).__mro__:
+            for attr, descriptor in vars(klass).items():
+                if isinstance(descriptor, Related):
+                    self._push_related(node.identity, getattr(obj, attr),
+                                       descriptor)
+
+    def _push_related(self, node_id, related, descriptor):
+        if isinstance(descriptor, RelatedTo):
+            direction = 1
+        elif isinstance(descriptor, RelatedFrom):
+            direction = -1
+        else:
+            direction = 0
+        rel_type = descriptor.relationship_type
+        wanted = {}
+        for other, properties in related._related_objects:
+            if other.__node__.graph is not self:
+                self._push_object(other)
+            wanted[other.__primaryvalue__] = dict(properties)
+        for rel_id, other_id in list(self._hops(node_id, rel_type,
+                                                direction=direction)):
+            if other_id in wanted:
+                self._rels[rel_id][3].clear()
+                self._rels[rel_id][3].update(wanted.pop(other_id))
+            else:
+                self.delete_rel(rel_id)
+        for other_id, properties in wanted.items():
+            if direction < 0:
+                self.create_rel(other_id, rel_type, node_id, **properties)
+            else:
+                self.create_rel(node_id, rel_type, other_id, **properties)
+
+    def _run_node_match(self, labels, node_id):
+        label = labels.strip(':`').split(':')[0].strip('`') if labels else ''
+        if node_id is not None:
+            ids = [int(node_id)] if self._has_label(int(node_id), label) else []
+        else:
+            ids = [n for n in sorted(self._nodes) if self._has_label(n, label)]
+        return FakeCursor([{'_': self._node(n)} for n in ids])
+
+    def _run_registered(self, name, params):
+        """Dispatches to _q_<name>. Shapes registered as 'shape:arg:...'
+        get their args passed positionally."""
+        shape, _, args = name.partition(':')
+        handler = getattr(self, '_q_' + shape, None)
+        if handler is None:
+            raise NotImplementedError('FakeGraph has no handler for %s' % name)
+        return handler(*(args.split(':') if args else ()), **params)
+
+    """
+    Registered queries.
+    """
+
+    def _q_one_hop(self, src_type, rel_type, dest_type, action, src_id):
+        action, action_entity = action.split(' ', 1)
+        if not self._has_label(src_id, src_type):
+            return FakeCursor()
+        hops = list(self._hops(src_id, rel_type, dest_type))
+        if action == 'DELETE':
+            for rel_id in set(rel_id for rel_id, _ in hops):
+                self.delete_rel(rel_id)
+            return FakeCursor(stats={'relationships_deleted': len(hops)})
+
+        distinct = action_entity.startswith('DISTINCT ')
+        columns = action_entity.replace('DISTINCT ', '', 1).split(', ')
+        rows = []
+        for rel_id, dest_id in hops:
+            row = {}
+            for column in columns:
+                if column == 'dest':
+                    row[column] = self._node(dest_id)
+                elif column == 'ID(dest)':
+                    row[column] = dest_id
+                elif column.startswith('rel.'):
+                    row[column] = self._rels[rel_id][3].get(column[4:])
+                elif column.startswith('dest.'):
+                    row[column] = self.properties(dest_id).get(column[5:])
+                else:
+                    raise NotImplementedError(action_entity)
+            if distinct and row in rows:
+                continue
+            rows.append(row)
+        return FakeCursor(rows)
+
+    def _q_delete_node(self, label, rel_type=None, dep_label=None,
+                       src_id=None):
+        if not self._has_label(src_id, label):
+            return FakeCursor()
+        doomed = [src_id]
+        if rel_type:
+            doomed += sorted(set(n for _, n in self._hops(
+                src_id, rel_type, dep_label, direction=1)))
+        rel_ids = set(r for d in doomed for r, _ in self._hops(d)
+                      if self._rels[r][0] not in LOG_RELS)
+        neighbours = sorted(set(n for d in doomed for r, n in self._hops(d)
+                                if n not in doomed and self._rels[r][0]
+                                not in LOG_RELS + ('SUGGESTED',)))
+        self._q_touch_nodes(neighbours)
+        for n in neighbours:
+            self._log_change(n, 'updated')
+        for d in doomed:
+            audience = set(q for r, q in self._hops(d, label='Person')
+                           if self._rels[r][0] in ('KNOWS', 'IS_MEMBER',
+                                                   'INVITED_TO'))
+            audience.update(q for _, c in self._hops(d, 'SCHEDULED', 'Circle',
+                                                     direction=-1)
+                            for _, q in self._hops(c, 'IS_MEMBER', 'Person',
+                                                   direction=-1))
+            audience -= set(doomed)
+            if audience:
+                change = self._log_change(d, 'deleted', anchor=None)
+                for q in sorted(audience):
+                    self.create_rel(q, 'SEES_CHANGE', change)
+        old = set(c for d in doomed for r, c in self._hops(d, 'HAS_CHANGE'))
+        old.update(c for d in doomed for _, c in self._hops(d, 'SEES_CHANGE')
+                   if len(list(self._hops(c, 'SEES_CHANGE'))) == 1)
+        for node_id in sorted(old) + doomed:
+            for rel_id, _ in list(self._hops(node_id)):
+                self.delete_rel(rel_id)
+            self.delete_node(node_id)
+        return FakeCursor([{'deleted_ids': doomed,
+                            'neighbour_ids': neighbours,
+                            'nodes_deleted': len(doomed),
+                            'relationships_deleted': len(rel_ids)}])
+
+    def _log_change(self, node_id, op, anchor=True):
+        """Records op as the latest change of node_id, in the Change node hung
+        off it, or in a new, unattached one if anchor is None. Returns the
+        Change node's ID."""
+        existing = ([c for _, c in self._hops(node_id, 'HAS_CHANGE',
+                                              direction=1)]
+                    if anchor else [])
+        # Change nodes have a label property, which create_node's signature
+        # cannot take.
+        change = existing[0] if existing else self.create_node('Change')
+        self.properties(change).update(
+            at=int(time.time() * 1000), entity_id=node_id,
+            label=sorted(self._nodes[node_id][0])[0], op=op)
+        if anchor and not existing:
+            self.create_rel(node_id, 'HAS_CHANGE', change)
+        return change
+
+    def _q_log_changes(self, changes):
+        for change in changes:
+            if change['id'] in self._nodes:
+                self._log_change(change['id'], change['op'])
+        return FakeCursor()
+
+    def _q_change_clock(self):
+        return FakeCursor([{'timestamp()': int(time.time() * 1000)}])
+
+    def _q_changes_since(self, person_id, since, after, limit):
+        if not self._has_label(person_id, 'Person'):
+            return FakeCursor()
+        circles = [c for _, c in self._hops(person_id, 'IS_MEMBER', 'Circle',
+                                            direction=1)]
+        visible = set([person_id] + circles)
+        visible.update(k for _, k in self._hops(person_id, 'KNOWS', 'Person'))
+        visible.update(e for _, e in self._hops(person_id, 'INVITED_TO',
+                                                'Event', direction=1))
+        visible.update(e for c in circles
+                       for _, e in self._hops(c, 'SCHEDULED', 'Event',
+                                              direction=1))
+        changes = [c for n in visible
+                   for _, c in self._hops(n, 'HAS_CHANGE', direction=1)]
+        changes += [c for _, c in self._hops(person_id, 'SEES_CHANGE',
+                                             direction=1)]
+        last = {}  # {(label, entity ID): (at, change ID)}
+        for c in changes:
+            ch = self.properties(c)
+            if (ch['at'], c) > (since, after):
+                key = ch['label'], ch['entity_id']
+                last[key] = max(last.get(key, (ch['at'], c)), (ch['at'], c))
+        matches = []
+        for (label, node_id), (at, c) in last.items():
+            version = (self.properties(node_id).get('version') or 0
+                       if self._has_label(node_id, label) else 0)
+            matches.append({'label': label, 'id': node_id,
+                            'op': self.properties(c)['op'], 'at': at,
+                            'change_id': c, 'version': version})
+        matches.sort(key=lambda m: (m['at'], m['change_id']))
+        return FakeCursor(matches[:limit])
+
+    def _q_circles_projection(self, circle_ids):
+        rows = []
+        for circle_id in circle_ids:
+            if not self._has_label(circle_id, 'Circle'):
+                continue
+            rows.append({
+                'circle': self._node(circle_id),
+                'member_ids': [p for _, p in self._hops(circle_id, 'IS_MEMBER',
+                                                        'Person')],
+                'event_ids': [e for _, e in self._hops(circle_id, 'SCHEDULED',
+                                                       'Event')]
+            })
+        return FakeCursor(rows)
+
+    def _q_events_projection(self, event_ids):
+        rows = []
+        for event_id in event_ids:
+            if not self._has_label(event_id, 'Event'):
+                continue
+            invitees = [[p, self._rels[r][3].get('attending')]
+                        for r, p in self._hops(event_id, 'INVITED_TO',
+                                               'Person')]
+            circles = [[c, self.properties(c).get('display_name')]
+                       for _, c in self._hops(event_id, 'SCHEDULED',
+                                              'Circle')]
+            rows.append({'event': self._node(event_id),
+                         'invitees': invitees, 'circles': circles})
+        return FakeCursor(rows)
+
+    def _q_nodes_by_ids(self, label, ids):
+        return FakeCursor([{'n': self._node(n)} for n in sorted(set(ids))
+                           if self._has_label(n, label)])
+
+    def _q_person_by_email(self, email):
+        for node_id in sorted(self._nodes):
+            if (self._has_label(node_id, 'Person')
+                    and self.properties(node_id).get('email') == email):
+                return FakeCursor([{'p': self._node(node_id)}])
+        return FakeCursor()
+
+    def _q_clear_messaging_tokens(self, recipients):
+        for recipient in recipients:
+            props = self._nodes.get(recipient['id'], (None, {}))[1]
+            if props.get('messaging_token') == recipient['token']:
+                props['messaging_token'] = None
+        return FakeCursor()
+
+    def _q_person_circles_page(self, person_id, after, limit):
+        ids = sorted(set(c for _, c in self._hops(person_id, 'IS_MEMBER',
+                                                  'Circle', direction=1)
+                         if c > after))
+        return FakeCursor([{'id': c} for c in ids[:limit]])
+
+    def _q_person_people_page(self, person_id, after, limit):
+        ids = sorted(set(p for _, p in self._hops(person_id, 'KNOWS', 'Person')
+                         if p > after))
+        return FakeCursor([{'p': self._node(p)} for p in ids[:limit]])
+
+    def _events_page(self, event_ids, start, after, limit, since, until):
+        keyed = sorted(set(
+            (_time(self.properties(e).get('start_datetime')), e)
+            for e in event_ids
+            if self.properties(e).get('start_datetime') is not None))
+        start, since, until = _time(start), _time(since), _time(until)
+        return FakeCursor([
+            {'id': e, 'start': t} for t, e in keyed
+            if (since is None or t >= since) and (until is None or t < until)
+            and (start is None or (t, e) > (start, after))][:limit])
+
+    def _q_person_events_page(self, person_id, start, after, limit,
+                              since=None, until=None):
+        return self._events_page(
+            [e for _, e in self._hops(person_id, 'INVITED_TO', 'Event',
+                                      direction=1)
+             if self._has_label(person_id, 'Person')],
+            start, after, limit, since, until)
+
+    def _q_circle_events_page(self, circle_id, start, after, limit,
+                              since=None, until=None):
+        return self._events_page(
+            [e for _, e in self._hops(circle_id, 'SCHEDULED', 'Event',
+                                      direction=1)
+             if self._has_label(circle_id, 'Circle')],
+            start, after, limit, since, until)
+
+    def _q_event_times(self, after, limit):
+        keys = ('start_datetime', 'end_datetime', 'created_at')
+        return FakeCursor([
+            dict({k: self.properties(e).get(k) for k in keys}, id=e)
+            for e in sorted(self._nodes)
+            if e > after and self._has_label(e, 'Event')
+        ][:limit])
+
+    def _q_event_locations(self, after, limit):
+        return FakeCursor([
+            {'id': e, 'latlng': self.properties(e).get('latlng')}
+            for e in sorted(self._nodes)
+            if e > after and self._has_label(e, 'Event')
+        ][:limit])
+
+    def _q_nearby_events(self, person_id, center, radius, limit, since=None,
+                         until=None):
+        center, since, until = _point(center), _time(since), _time(until)
+        events = set(
+            e for _, c in self._hops(person_id, 'IS_MEMBER', 'Circle',
+                                     direction=1)
+            for _, e in self._hops(c, 'SCHEDULED', 'Event', direction=1)
+            if self._has_label(person_id, 'Person'))
+        matches = []
+        for e in events:
+            props = self.properties(e)
+            if not isinstance(props.get('latlng'), FakePoint):
+                continue
+            t = _time(props.get('start_datetime'))
+            if since is not None and (t is None or t < since):
+                continue
+            if until is not None and (t is None or t >= until):
+                continue
+            d = _distance(props['latlng'], center)
+            if d <= radius:
+                matches.append({'id': e, 'version': props.get('version'),
+                                'distance': d})
+        matches.sort(key=lambda m: (m['distance'], m['id']))
+        return FakeCursor(matches[:limit])
+
+    def _q_is_member(self, person_id, circle_id):
+        return FakeCursor([{'member': any(
+            c == circle_id for _, c in self._hops(person_id, 'IS_MEMBER',
+                                                  'Circle', direction=1))}])
+
+    def _q_is_invited(self, person_id, event_id):
+        return FakeCursor([{'invited': any(
+            e == event_id for _, e in self._hops(person_id, 'INVITED_TO',
+                                                 'Event', direction=1))}])
+
+    def _q_person_feed(self, person_id, start, end):
+        if not self._has_label(person_id, 'Person'):
+            return FakeCursor()
+        circles = []
+        for _, c in self._hops(person_id, 'IS_MEMBER', 'Circle', direction=1):
+            props = self.properties(c)
+            circles.append({
+                'id': c, 'display_name': props.get('display_name'),
+                'description': props.get('description'),
+                'owner_id': props.get('owner_id'),
+                'member_count': len(list(self._hops(c, 'IS_MEMBER',
+                                                    direction=-1)))})
+        events = []
+        for r, e in self._hops(person_id, 'INVITED_TO', 'Event', direction=1):
+            props = self.properties(e)
+            t = _time(props.get('start_datetime'))
+            if t is None or not _time(start) <= t < _time(end):
+                continue
+            event = {k: props.get(k) for k in (
+                'display_name', 'location', 'latlng', 'start_datetime',
+                'end_datetime', 'owner_id', 'circle_id')}
+            event.update(id=e, attending=self._rels[r][3].get('attending'))
+            events.append(event)
+        events.sort(key=lambda e: (_time(e['start_datetime']), e['id']))
+        return FakeCursor([{'circles': circles, 'events': events}])
+
+    def _q_person_relationships(self, person_id):
+        if not self._has_label(person_id, 'Person'):
+            return FakeCursor()
+        return FakeCursor([{
+            'knows': [p for _, p in self._hops(person_id, 'KNOWS', 'Person')],
+            'circles': [c for _, c in self._hops(person_id, 'IS_MEMBER',
+                                                 'Circle', direction=1)],
+            'events': [[e, self._rels[r][3].get('attending')]
+                       for r, e in self._hops(person_id, 'INVITED_TO',
+                                              'Event', direction=1)]
+        }])
+
+    def _q_create_nodes(self, label, rows):
+        return FakeCursor([
+            {'key': row['key'],
+             'id': self.create_node(label, **{
+                 k: v for k, v in self._row_properties(row).items()
+                 if v is not None})}
+            for row in rows])
+
+    @staticmethod
+    def _row_properties(row):
+        properties = dict(row['properties'])
+        properties.update((k, _point(p)) for k, p in row['points'].items())
+        return properties
+
+    def _q_update_nodes(self, label, rows):
+        for row in rows:
+            if self._has_label(row['id'], label):
+                self.properties(row['id']).update(self._row_properties(row))
+        return FakeCursor()
+
+    def _q_touch_nodes(self, ids):
+        for node_id in ids:
+            if node_id in self._nodes:
+                props = self.properties(node_id)
+                props['version'] = (props.get('version') or 0) + 1
+        return FakeCursor()
+
+    def _q_versions_of(self, ids):
+        return FakeCursor([{'id': n,
+                            'version': self.properties(n).get('version') or 0}
+                           for n in ids if n in self._nodes])
+
+    def _q_relate(self, rel_type, directed, pairs):
+        for pair in pairs:
+            start, end = pair['start'], pair['end']
+            if start not in self._nodes or end not in self._nodes:
+                continue
+            direction = 1 if directed == 'directed' else 0
+            existing = [r for r, other in self._hops(start, rel_type,
+                                                     direction=direction)
+                        if other == end]
+            if existing:
+                self._rels[existing[0]][3].update(pair['properties'])
+            else:
+                self.create_rel(start, rel_type, end, **pair['properties'])
+        return FakeCursor()
+
+    def _q_unrelate(self, rel_type, pairs):
+        for pair in pairs:
+            for rel_id, other in list(self._hops(pair['start'], rel_type)):
+                if other == pair['end']:
+                    self.delete_rel(rel_id)
+        return FakeCursor()
+
+    def _suggestion(self, a, b):
+        """Returns the ID of the SUGGESTED relationship from a to b, creating
+        it if needed."""
+        for rel_id, other in self._hops(a, 'SUGGESTED', direction=1):
+            if other == b:
+                return rel_id
+        return self.create_rel(a, 'SUGGESTED', b)
+
+    def _score_suggestion(self, rel_id):
+        props = self._rels[rel_id][3]
+        props['score'] = (2 * props.get('mutual_friends', 0)
+                          + props.get('shared_circles', 0))
+        if props['score'] <= 0:
+            self.delete_rel(rel_id)
+
+    def _q_adjust_suggestions(self, rel_type, hubs, limit):
+        label, prop = cypher.SUGGESTION_SIGNALS[rel_type]
+        for row in hubs:
+            if not self._has_label(row['hub'], label):
+                continue
+            changed = row['added'] + row['removed']
+            kept = sorted(set(k for _, k in self._hops(row['hub'], rel_type,
+                                                       'Person')
+                              if k not in changed))
+            was_on = len(kept) + len(row['removed']) <= limit
+            is_on = len(kept) + len(row['added']) <= limit
+            if was_on and is_on:
+                deltas = [(x, y, delta)
+                          for change, delta in (('added', 1), ('removed', -1))
+                          for x in row[change]
+                          for y in kept + [z for z in row[change] if z > x]]
+            elif was_on or is_on:
+                people = kept + row['removed' if was_on else 'added']
+                deltas = [(x, y, -1 if was_on else 1)
+                          for x in people for y in people if y > x]
+            else:
+                deltas = []
+            for x, y, delta in deltas:
+                if not (self._has_label(x, 'Person')
+                        and self._has_label(y, 'Person')):
+                    continue
+                for a, b in ((x, y), (y, x)):
+                    rel_id = self._suggestion(a, b)
+                    props = self._rels[rel_id][3]
+                    props[prop] = props.get(prop, 0) + delta
+                    self._score_suggestion(rel_id)
+        return FakeCursor()
+
+    def _q_drop_suggestion_hub(self, rel_type, hub_id, limit):
+        label, prop = cypher.SUGGESTION_SIGNALS[rel_type]
+        if not self._has_label(hub_id, label):
+            return FakeCursor()
+        people = set(x for _, x in self._hops(hub_id, rel_type, 'Person'))
+        if len(people) > limit:
+            return FakeCursor()
+        for a in people:
+            for rel_id, b in list(self._hops(a, 'SUGGESTED', direction=1)):
+                if b in people:
+                    props = self._rels[rel_id][3]
+                    props[prop] = props.get(prop, 0) - 1
+                    self._score_suggestion(rel_id)
+        return FakeCursor()
+
+    def _q_suggestions_for(self, person_id, limit):
+        known = set(k for _, k in self._hops(person_id, 'KNOWS', 'Person'))
+        ranked = sorted(
+            (-self._rels[r][3]['score'], q, r)
+            for r, q in self._hops(person_id, 'SUGGESTED', 'Person',
+                                   direction=1) if q not in known)
+        return FakeCursor([{
+            'person': self._node(q),
+            'mutual_friends': self._rels[r][3].get('mutual_friends', 0),
+            'shared_circles': self._rels[r][3].get('shared_circles', 0)
+        } for _, q, r in ranked[:limit]])
+
+    def _q_clear_suggestions(self):
+        for rel_id in [r for r, rel in self._rels.items()
+                       if rel[0] == 'SUGGESTED']:
+            self.delete_rel(rel_id)
+        return FakeCursor()
+
+    def _q_rebuild_suggestions(self, rel_type, limit):
+        label, prop = cypher.SUGGESTION_SIGNALS[rel_type]
+        counts = defaultdict(int)
+        for hub in list(self._nodes):
+            if not self._has_label(hub, label):
+                continue
+            people = set(x for _, x in self._hops(hub, rel_type, 'Person'))
+            if len(people) > limit:
+                continue
+            for a in people:
+                for b in people:
+                    if a != b:
+                        counts[(a, b)] += 1
+        for (a, b), n in counts.items():
+            self._rels[self._suggestion(a, b)][3][prop] = n
+        return FakeCursor()
+
+    def _q_score_suggestions(self):
+        for rel_id in [r for r, rel in self._rels.items()
+                       if rel[0] == 'SUGGESTED']:
+            self._score_suggestion(rel_id)
+        return FakeCursor()
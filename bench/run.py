@@ -0,0 +1,190 @@
+"""
+Latency benchmark for the Flask app against an in-memory graph.
+
+    python -m bench.run --people 500 --circles 50 --requests 200
+
+Firebase token verification and FCM are stubbed out, and Neo4j is replaced by
+a FakeGraph seeded with a synthetic social graph. For every endpoint this
+reports p50/p99 latency and the number of Neo4j round trips per request, which
+is what N+1 regressions show up in.
+"""
+import argparse
+import random
+import time
+
+import auth
+import instrument
+import pagination
+from bench import synthetic
+from bench.fake_graph import FakeGraph
+
+API = '/circles/api/v1.0'
+
+
+class StubVerifier(object):
+    """Stands in for firebase_admin.auth. A token is 'token:<email>'."""
+
+    def __init__(self, ttl=3600):
+        self.ttl = ttl
+
+    def verify_id_token(self, token):
+        return {'email': token.split(':', 1)[1],
+                'exp': int(time.time()) + self.ttl}
+
+
+def install(graph):
+    """Points the app at graph with Firebase and FCM stubbed out, and returns
+    the Flask app."""
+    import main
+    import notif_manager
+    main.graph = instrument.install(graph)
+    main.fb_auth = StubVerifier()
+    main.token_cache = auth.TokenCache()
+    notif_manager.push_service = notif_manager.FakePushService()
+    return main.app
+
+
+def token_for(world_graph, person_id):
+    return 'token:' + world_graph.properties(person_id)['email']
+
+
+def endpoints(world, rng):
+    """Returns {endpoint name: function returning (url, requester ID)}."""
+    def person():
+        return rng.choice(world.people)
+
+    def circle():
+        c_id = rng.choice(world.circles)
+        return c_id, rng.choice(world.members[c_id])
+
+    def event():
+        e_id = rng.choice(world.events)
+        return e_id, rng.choice(world.invitees[e_id])
+
+    def by_person(suffix):
+        def pick():
+            p_id = person()
+            return '%s/users/%d%s' % (API, p_id, suffix), p_id
+        return pick
+
+    def by_circle(suffix):
+        def pick():
+            c_id, p_id = circle()
+            return '%s/circles/%d%s' % (API, c_id, suffix), p_id
+        return pick
+
+    def by_event(suffix):
+        def pick():
+            e_id, p_id = event()
+            return '%s/events/%d%s' % (API, e_id, suffix), p_id
+        return pick
+
+    def batch():
+        c_id, p_id = circle()
+        e_ids = [e for e, guests in world.invitees.items() if p_id in guests]
+        return '%s/batch?people=%s&circles=%d&events=%s' % (
+            API, ','.join(map(str, world.members[c_id])), c_id,
+            ','.join(map(str, e_ids))), p_id
+
+    def sync():
+        p_id = person()
+        token = pagination.encode({'at': 0, 'id': -1})
+        return '%s/sync?since=%s' % (API, token), p_id
+
+    def nearby():
+        p_id = person()
+        return ('%s/events/nearby?lat=37.4275&lng=-122.1697&radius=10000'
+                % API), p_id
+
+    return {
+        'GET /users/<id>': by_person(''),
+        'GET /users/<id>/circles': by_person('/circles'),
+        'GET /users/<id>/events': by_person('/events'),
+        'GET /users/<id>/people': by_person('/people'),
+        'GET /users/<id>/suggestions': by_person('/suggestions'),
+        'GET /users/<id>/feed': by_person('/feed?from=2020-01-01T00:00:00'),
+        'GET /circles/<id>': by_circle(''),
+        'GET /circles/<id>/people': by_circle('/people'),
+        'GET /circles/<id>/events': by_circle('/events'),
+        'GET /events/<id>': by_event(''),
+        'GET /events/nearby': nearby,
+        'GET /sync': sync,
+        'GET /batch': batch,
+    }
+
+
+def percentile(samples, q):
+    ordered = sorted(samples)
+    return ordered[int(round(q * (len(ordered) - 1)))]
+
+
+def benchmark(graph, app, world, requests=100, seed=0):
+    """Issues `requests` requests per endpoint. Returns {endpoint name:
+    {p50_ms, p99_ms, mean_ms, queries, errors}} where queries is the mean
+    number of Neo4j round trips per request."""
+    rng = random.Random(seed)
+    client = app.test_client()
+    results = {}
+    for name, pick in endpoints(world, rng).items():
+        latencies, queries, errors = [], [], 0
+        for _ in range(requests):
+            url, requester = pick()
+            headers = {'Authorization': token_for(graph, requester)}
+            before = graph.query_count
+            start = time.perf_counter()
+            response = client.get(url, headers=headers)
+            latencies.append((time.perf_counter() - start) * 1000)
+            queries.append(graph.query_count - before)
+            if response.status_code != 200:
+                errors += 1
+        results[name] = {
+            'p50_ms': percentile(latencies, 0.5),
+            'p99_ms': percentile(latencies, 0.99),
+            'mean_ms': sum(latencies) / len(latencies),
+            'queries': sum(queries) / len(queries),
+            'errors': errors
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--people', type=int, default=200)
+    parser.add_argument('--circles', type=int, default=20)
+    parser.add_argument('--members', type=int, default=10,
+                        help='members per circle')
+    parser.add_argument('--events', type=int, default=5,
+                        help='events per circle')
+    parser.add_argument('--invitees', type=int, default=8,
+                        help='invitees per event')
+    parser.add_argument('--friends', type=int, default=5,
+                        help='people each person knows')
+    parser.add_argument('--requests', type=int, default=100,
+                        help='requests per endpoint')
+    parser.add_argument('--latency-ms', type=float, default=0.0,
+                        help='simulated Neo4j round-trip time')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    graph = FakeGraph(latency=args.latency_ms / 1000)
+    world = synthetic.generate(graph, people=args.people,
+                               circles=args.circles, members=args.members,
+                               events=args.events, invitees=args.invitees,
+                               friends=args.friends, seed=args.seed)
+    app = install(graph)
+    # The first request runs the app's startup hooks; keep it out of results.
+    app.test_client().get('%s/getid' % API, headers={
+        'Authorization': token_for(graph, world.people[0])})
+
+    results = benchmark(graph, app, world, requests=args.requests,
+                        seed=args.seed)
+    print('{:<28} {:>9} {:>9} {:>9} {:>8} {:>6}'.format(
+        'endpoint', 'p50 ms', 'p99 ms', 'mean ms', 'queries', 'errors'))
+    for name, r in results.items():
+        print('{:<28} {:>9.2f} {:>9.2f} {:>9.2f} {:>8.1f} {:>6}'.format(
+            name, r['p50_ms'], r['p99_ms'], r['mean_ms'], r['queries'],
+            r['errors']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+Generate synthetic social graphs in a FakeGraph.
+"""
+import random
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+import cypher
+from bench.fake_graph import FakePoint
+
+World = namedtuple('World', ['people', 'circles', 'events', 'members',
+                             'invitees'])
+
+
+def generate(graph, people=200, circles=20, members=10, events=5,
+             invitees=8, friends=5, seed=0):
+    """Populates graph and returns a World of the created IDs.
+
+    Each circle gets `members` random members (its owner among them) and
+    `events` scheduled events. Each event invites `invitees` of the circle's
+    members, and each person KNOWS about `friends` random others.
+    """
+    rng = random.Random(seed)
+    now = datetime(2020, 1, 1)
+
+    person_ids = [
+        graph.create_node('Person', display_name='Person %d' % i,
+                          email='person%d@example.com' % i, photo=None,
+                          messaging_token='token-%d' % i)
+        for i in range(people)]
+
+    for p_id in person_ids:
+        for other in rng.sample(person_ids, min(friends, people - 1)):
+            if other != p_id:
+                graph.create_rel(p_id, 'KNOWS', other)
+
+    circle_ids, event_ids = [], []
+    circle_members, event_invitees = {}, {}
+    for i in range(circles):
+        circle_people = rng.sample(person_ids, min(members, people))
+        owner_id = circle_people[0]
+        c_id = graph.create_node('Circle', display_name='Circle %d' % i,
+                                 description='Synthetic circle',
+                                 owner_id=owner_id, members_can_add=True,
+                                 members_can_ping=True)
+        circle_ids.append(c_id)
+        circle_members[c_id] = circle_people
+        for p_id in circle_people:
+            graph.create_rel(p_id, 'IS_MEMBER', c_id)
+
+        for j in range(events):
+            start = now + timedelta(days=rng.randint(-30, 60),
+                                    hours=rng.randint(0, 23))
+            e_id = graph.create_node(
+                'Event', display_name='Event %d.%d' % (i, j),
+                description='Synthetic event', location='Somewhere',
+                latlng=FakePoint(
+                    round(37.4275 + rng.uniform(-0.2, 0.2), 4),
+                    round(-122.1697 + rng.uniform(-0.2, 0.2), 4)),
+                start_datetime=start,
+                end_datetime=start + timedelta(hours=2),
+                created_at=now, owner_id=owner_id,
+                circle_id=c_id)
+            event_ids.append(e_id)
+            graph.create_rel(c_id, 'SCHEDULED', e_id)
+            guests = rng.sample(circle_people,
+                                min(invitees, len(circle_people)))
+            event_invitees[e_id] = guests
+            for p_id in guests:
+                graph.create_rel(p_id, 'INVITED_TO', e_id,
+                                 attending=rng.random() < 0.5)
+
+    # Suggestion scores, as the app would have maintained them.
+    cypher.rebuild_suggestions(graph)
+
+    return World(person_ids, circle_ids, event_ids, circle_members,
+                 event_invitees)
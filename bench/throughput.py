@@ -0,0 +1,95 @@
+"""
+Throughput of the Flask app under concurrent requests against an in-memory
+graph, for a range of worker thread counts.
+
+    python -m bench.throughput --threads 1,2,4,8,16 --latency-ms 5
+
+Each thread count gets a GraphPool of the same size, as with the gunicorn
+threaded setup in app.yaml, and every thread issues --requests requests
+spread over the read endpoints. Neo4j round trips are simulated by sleeping
+--latency-ms, which is what threads overlap; with no latency the GIL keeps
+throughput flat.
+"""
+import argparse
+import random
+import threading
+import time
+
+import pool
+from bench import synthetic
+from bench.fake_graph import FakeGraph
+from bench.run import endpoints, install, percentile, token_for
+
+
+def serve(graph, app, world, threads, requests, seed=0):
+    """Issues `requests` requests from each of `threads` threads. Returns
+    {requests_per_s, p50_ms, p99_ms, errors, pool}."""
+    import main
+    main.graph_pool = pool.GraphPool(lambda: graph, size=threads)
+    main.graph = pool.PooledGraph(main.graph_pool)
+    latencies, errors = [], []
+
+    def worker(n):
+        rng = random.Random(seed + n)
+        picks = list(endpoints(world, rng).values())
+        client = app.test_client()
+        mine, failed = [], 0
+        for i in range(requests):
+            url, requester = picks[i % len(picks)]()
+            headers = {'Authorization': token_for(graph, requester)}
+            start = time.perf_counter()
+            response = client.get(url, headers=headers)
+            mine.append((time.perf_counter() - start) * 1000)
+            if response.status_code != 200:
+                failed += 1
+        latencies.extend(mine)
+        errors.append(failed)
+
+    workers = [threading.Thread(target=worker, args=(n,))
+               for n in range(threads)]
+    start = time.perf_counter()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    elapsed = time.perf_counter() - start
+    return {
+        'requests_per_s': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 0.5),
+        'p99_ms': percentile(latencies, 0.99),
+        'errors': sum(errors),
+        'pool': main.graph_pool.stats()
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--threads', default='1,2,4,8,16',
+                        help='comma-separated worker thread counts')
+    parser.add_argument('--requests', type=int, default=100,
+                        help='requests per thread')
+    parser.add_argument('--people', type=int, default=200)
+    parser.add_argument('--circles', type=int, default=20)
+    parser.add_argument('--latency-ms', type=float, default=5.0,
+                        help='simulated Neo4j round-trip time')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    graph = FakeGraph(latency=args.latency_ms / 1000)
+    world = synthetic.generate(graph, people=args.people,
+                               circles=args.circles, seed=args.seed)
+    app = install(graph)
+    app.test_client().get('/circles/api/v1.0/getid', headers={
+        'Authorization': token_for(graph, world.people[0])})
+
+    print('{:>7} {:>10} {:>9} {:>9} {:>6}'.format(
+        'threads', 'req/s', 'p50 ms', 'p99 ms', 'errors'))
+    for threads in [int(t) for t in args.threads.split(',')]:
+        r = serve(graph, app, world, threads, args.requests, args.seed)
+        print('{:>7} {:>10.1f} {:>9.2f} {:>9.2f} {:>6}'.format(
+            threads, r['requests_per_s'], r['p50_ms'], r['p99_ms'],
+            r['errors']))
+
+
+if __name__ == '__main__':
+    main()
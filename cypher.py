@@ -1,56 +1,702 @@
 """
 Library for functions related to cypher queries.
+
+Every query shape is registered once with $param placeholders and executed by
+name, so Neo4j can reuse its cached plan across requests.
 """
-from enum import Enum
-from string import Template
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from threading import Lock
+
+import doc_cache
+
+Query = namedtuple('Query', ['name', 'text'])
+
+_queries = {}
+_stats = {}
+_stats_lock = Lock()
+
+
+def register(name, text):
+    """Registers a query shape under name and returns it. Registering a name
+    again is a no-op if the text is unchanged."""
+    query = _queries.get(name)
+    if query is None:
+        query = _queries.setdefault(name, Query(name, text))
+    if query.text != text:
+        raise ValueError('Query %s is already registered.' % name)
+    return query
+
+
+def run(graph, name, **params):
+    """Runs the registered query name with params on graph (or on an open
+    transaction) and records its timing. Returns the py2neo cursor."""
+    query = _queries[name]
+    start = time.perf_counter()
+    try:
+        return graph.run(query.text, params)
+    finally:
+        _record(name, time.perf_counter() - start)
+
+
+def lookup(text):
+    """Returns the registered Query whose text is text, or None."""
+    for query in list(_queries.values()):
+        if query.text == text:
+            return query
+    return None
+
+
+def _record(name, elapsed):
+    elapsed_ms = elapsed * 1000
+    with _stats_lock:
+        stats = _stats.setdefault(name, {'count': 0, 'total_ms': 0.0,
+                                         'max_ms': 0.0})
+        stats['count'] += 1
+        stats['total_ms'] += elapsed_ms
+        stats['max_ms'] = max(stats['max_ms'], elapsed_ms)
+
+
+def query_stats():
+    """Returns {query name: {count, total_ms, max_ms}} since the last reset."""
+    with _stats_lock:
+        return {name: dict(stats) for name, stats in _stats.items()}
+
 
+def reset_query_stats():
+    with _stats_lock:
+        _stats.clear()
 
-def construct_query(src_type='', src_id='', rel_type='', dest_type='',
-                    action='RETURN', action_entity='ID(dest)'):
+
+def construct_query(src_type='', rel_type='', dest_type='', action='RETURN',
+                    action_entity='ID(dest)'):
+    """Registers the one-hop query shape for the given types and returns its
+    name. The source node ID is passed as the $src_id parameter."""
+    name = 'one_hop:%s:%s:%s:%s %s' % (src_type or '', rel_type or '',
+                                       dest_type or '', action, action_entity)
     if src_type:
         src_type = ':' + src_type
     if rel_type:
         rel_type = ':' + rel_type
     if dest_type:
         dest_type = ':' + dest_type
-    query = Template('MATCH (src$src_type)-[rel$rel_type]-(dest$dest_type) WHERE ID(src)=$src_id $action $action_entity').substitute(
-        src_type=src_type, rel_type=rel_type, dest_type=dest_type,
-        src_id=src_id, action=action, action_entity=action_entity)
-    return query
+    text = ('MATCH (src%s)-[rel%s]-(dest%s) WHERE ID(src)=$src_id %s %s'
+            % (src_type, rel_type, dest_type, action, action_entity))
+    return register(name, text).name
 
 
 def one_hop_from_id(graph, src_id, src_type, rel_type, dest_type,
                     action_entity):
     """Returns list of matches. Each match is a dictionary with keys being
     the action_entity specified."""
-    query = construct_query(src_type=src_type, src_id=src_id,
-                            rel_type=rel_type, dest_type=dest_type,
-                            action_entity=action_entity)
-    matches = graph.run(query).data()
-    return matches
+    name = construct_query(src_type=src_type, rel_type=rel_type,
+                           dest_type=dest_type, action_entity=action_entity)
+    return run(graph, name, src_id=src_id).data()
+
+
+register('circles_projection',
+         'UNWIND $circle_ids AS circle_id '
+         'MATCH (src:Circle) WHERE ID(src)=circle_id '
+         'RETURN src AS circle, '
+         '[(src)-[:IS_MEMBER]-(p:Person) | ID(p)] AS member_ids, '
+         '[(src)-[:SCHEDULED]-(e:Event) | ID(e)] AS event_ids')
+
+
+def circles_projection(graph, circle_ids):
+    """Returns one match per existing circle in circle_ids, each holding the
+    circle node, its member IDs and its scheduled event IDs."""
+    return run(graph, 'circles_projection',
+               circle_ids=list(circle_ids)).data()
+
+
+def circle_projection(graph, circle_id):
+    """Returns the circles_projection match for one circle, or None if the
+    circle does not exist."""
+    matches = circles_projection(graph, [circle_id])
+    return matches[0] if matches else None
+
+
+register('events_projection',
+         'UNWIND $event_ids AS event_id '
+         'MATCH (src:Event) WHERE ID(src)=event_id '
+         'RETURN src AS event, '
+         '[(src)-[rel:INVITED_TO]-(p:Person) | [ID(p), rel.attending]] '
+         'AS invitees, '
+         '[(src)-[:SCHEDULED]-(c:Circle) | [ID(c), c.display_name]] '
+         'AS circles')
+
+
+def events_projection(graph, event_ids):
+    """Returns one match per existing event in event_ids, each holding the
+    event node, its invitees as [ID, attending] pairs and its circles as
+    [ID, display_name] pairs."""
+    return run(graph, 'events_projection', event_ids=list(event_ids)).data()
+
+
+def nodes_by_ids(graph, label, ids):
+    """Returns the label nodes whose IDs are in ids, in no particular order."""
+    name = register('nodes_by_ids:%s' % label,
+                    'MATCH (n:%s) WHERE ID(n) IN $ids RETURN n' % label).name
+    return [m['n'] for m in run(graph, name, ids=list(ids)).data()]
+
+
+register('person_by_email',
+         'MATCH (p:Person) WHERE p.email=$email RETURN p LIMIT 1')
+
+
+def person_by_email(graph, email):
+    """Returns the Person node with the given email, or None."""
+    return run(graph, 'person_by_email', email=email).evaluate()
+
+
+register('event_times',
+         'MATCH (e:Event) WHERE ID(e) > $after '
+         'RETURN ID(e) AS id, e.start_datetime AS start_datetime, '
+         'e.end_datetime AS end_datetime, e.created_at AS created_at '
+         'ORDER BY id LIMIT $limit')
+
+
+def event_times(graph, after, limit):
+    """Returns up to limit matches of the stored start, end and creation
+    times of events with IDs above after, in ID order."""
+    return run(graph, 'event_times', after=after, limit=limit).data()
+
+
+register('event_locations',
+         'MATCH (e:Event) WHERE ID(e) > $after '
+         'RETURN ID(e) AS id, e.latlng AS latlng ORDER BY id LIMIT $limit')
+
+
+def event_locations(graph, after, limit):
+    """Returns up to limit matches of the stored latlng of events with IDs
+    above after, in ID order."""
+    return run(graph, 'event_locations', after=after, limit=limit).data()
+
+
+# The distance predicate on e.latlng is answered from the point index; only
+# events in range are then checked for a circle the person is a member of.
+register('nearby_events',
+         'MATCH (e:Event) '
+         'WHERE distance(e.latlng, point($center)) <= $radius '
+         'WITH e, e.start_datetime AS t '
+         'WHERE ($since IS NULL OR t >= localdatetime($since)) '
+         'AND ($until IS NULL OR t < localdatetime($until)) '
+         'MATCH (p:Person)-[:IS_MEMBER]->(:Circle)-[:SCHEDULED]->(e) '
+         'WHERE ID(p)=$person_id '
+         'WITH DISTINCT e '
+         'RETURN ID(e) AS id, e.version AS version, '
+         'distance(e.latlng, point($center)) AS distance '
+         'ORDER BY distance, id LIMIT $limit')
+
+
+def nearby_events(graph, person_id, center, radius, limit, since=None,
+                  until=None):
+    """Returns up to limit matches of {id, version, distance} for events in
+    the person's circles within radius meters of center ({latitude,
+    longitude}), nearest first. since and until bound start times."""
+    return run(graph, 'nearby_events', person_id=person_id, center=center,
+               radius=radius, limit=limit, since=since, until=until).data()
+
+
+register('clear_messaging_tokens',
+         'UNWIND $recipients AS recipient '
+         'MATCH (p:Person) WHERE ID(p)=recipient.id '
+         'AND p.messaging_token=recipient.token '
+         'SET p.messaging_token=NULL')
+
+
+def clear_messaging_tokens(graph, recipients):
+    """Clears messaging tokens given as (person ID, token) pairs, unless the
+    person has since registered a different token."""
+    run(graph, 'clear_messaging_tokens',
+        recipients=[{'id': p_id, 'token': token}
+                    for p_id, token in recipients])
+
+
+register('person_circles_page',
+         'MATCH (src:Person)-[:IS_MEMBER]->(c:Circle) '
+         'WHERE ID(src)=$person_id AND ID(c) > $after '
+         'RETURN DISTINCT ID(c) AS id ORDER BY id LIMIT $limit')
+
+
+def person_circles_page(graph, person_id, after, limit):
+    """Returns up to limit IDs of the person's circles with IDs above after,
+    in ID order."""
+    return [m['id'] for m in run(graph, 'person_circles_page',
+                                 person_id=person_id, after=after,
+                                 limit=limit).data()]
+
+
+register('person_people_page',
+         'MATCH (src:Person)-[:KNOWS]-(p:Person) '
+         'WHERE ID(src)=$person_id AND ID(p) > $after '
+         'RETURN DISTINCT p ORDER BY ID(p) LIMIT $limit')
+
+
+def person_people_page(graph, person_id, after, limit):
+    """Returns up to limit nodes of people the person knows with IDs above
+    after, in ID order."""
+    return [m['p'] for m in run(graph, 'person_people_page',
+                                person_id=person_id, after=after,
+                                limit=limit).data()]
+
+
+# Events are paged in (start_datetime, ID) order, optionally only those
+# starting in [$since, $until). Times are passed as ISO 8601 strings, or null
+# for no bound. Events without a start time have no place in that order, and
+# would give a cursor without a start, so they are left out.
+_EVENTS_PAGE = ('WITH DISTINCT e, e.start_datetime AS t '
+                'WHERE t IS NOT NULL '
+                'AND ($since IS NULL OR t >= localdatetime($since)) '
+                'AND ($until IS NULL OR t < localdatetime($until)) '
+                'AND ($start IS NULL OR t > localdatetime($start) OR '
+                '(t = localdatetime($start) AND ID(e) > $after)) '
+                'RETURN ID(e) AS id, t AS start '
+                'ORDER BY t, id LIMIT $limit')
+register('person_events_page',
+         'MATCH (src:Person)-[:INVITED_TO]->(e:Event) '
+         'WHERE ID(src)=$person_id ' + _EVENTS_PAGE)
+register('circle_events_page',
+         'MATCH (src:Circle)-[:SCHEDULED]->(e:Event) '
+         'WHERE ID(src)=$circle_id ' + _EVENTS_PAGE)
+
+
+def person_events_page(graph, person_id, start, after, limit, since=None,
+                       until=None):
+    """Returns up to limit matches of {'id', 'start'} for the person's events
+    starting in [since, until) that sort after (start, after)."""
+    return run(graph, 'person_events_page', person_id=person_id, start=start,
+               after=after, limit=limit, since=since, until=until).data()
+
+
+def circle_events_page(graph, circle_id, start, after, limit, since=None,
+                       until=None):
+    """Returns up to limit matches of {'id', 'start'} for the circle's events
+    starting in [since, until) that sort after (start, after)."""
+    return run(graph, 'circle_events_page', circle_id=circle_id, start=start,
+               after=after, limit=limit, since=since, until=until).data()
+
+
+register('is_member',
+         'MATCH (p:Person), (c:Circle) '
+         'WHERE ID(p)=$person_id AND ID(c)=$circle_id '
+         'RETURN exists((p)-[:IS_MEMBER]->(c))')
+register('is_invited',
+         'MATCH (p:Person), (e:Event) '
+         'WHERE ID(p)=$person_id AND ID(e)=$event_id '
+         'RETURN exists((p)-[:INVITED_TO]->(e))')
+
+
+def is_member(graph, person_id, circle_id):
+    """Whether the person is a member of the circle."""
+    return bool(run(graph, 'is_member', person_id=person_id,
+                    circle_id=circle_id).evaluate())
+
+
+def is_invited(graph, person_id, event_id):
+    """Whether the person is invited to the event."""
+    return bool(run(graph, 'is_invited', person_id=person_id,
+                    event_id=event_id).evaluate())
+
+
+register('person_feed',
+         'MATCH (src:Person) WHERE ID(src)=$person_id '
+         'OPTIONAL MATCH (src)-[rel:INVITED_TO]->(e:Event) '
+         'WHERE e.start_datetime >= localdatetime($start) '
+         'AND e.start_datetime < localdatetime($end) '
+         'WITH src, rel, e ORDER BY e.start_datetime, ID(e) '
+         'WITH src, collect(e {.display_name, .location, .latlng, '
+         '.start_datetime, .end_datetime, .owner_id, .circle_id, id: ID(e), '
+         'attending: rel.attending}) AS events '
+         'RETURN [(src)-[:IS_MEMBER]->(c:Circle) | c {.display_name, '
+         '.description, .owner_id, id: ID(c), '
+         'member_count: size((c)<-[:IS_MEMBER]-())}] AS circles, events')
+
+
+def person_feed(graph, person_id, start, end):
+    """Returns a match with the person's circles, with member counts, and
+    the events they are invited to that start in [start, end), in start
+    order with their attendance. None if the person does not exist."""
+    matches = run(graph, 'person_feed', person_id=person_id, start=start,
+                  end=end).data()
+    return matches[0] if matches else None
+
+
+register('person_relationships',
+         'MATCH (src:Person) WHERE ID(src)=$person_id '
+         'RETURN [(src)-[:KNOWS]-(p:Person) | ID(p)] AS knows, '
+         '[(src)-[:IS_MEMBER]->(c:Circle) | ID(c)] AS circles, '
+         '[(src)-[rel:INVITED_TO]->(e:Event) | [ID(e), rel.attending]] '
+         'AS events')
+
+
+def person_relationships(graph, person_id):
+    """Returns a match with the IDs of the people the person knows and the
+    circles they are in, and their events as [ID, attending] pairs."""
+    matches = run(graph, 'person_relationships', person_id=person_id).data()
+    return matches[0] if matches else None
+
+
+@contextmanager
+def transaction(graph):
+    """Yields a transaction that is committed if the block succeeds and
+    rolled back if it raises."""
+    tx = graph.begin()
+    try:
+        yield tx
+    except Exception:
+        tx.rollback()
+        raise
+    tx.commit()
+
+
+# Properties stored as WGS-84 points. The driver cannot send points as
+# parameters, so they are given as {latitude, longitude} maps and built with
+# point() in the write queries below.
+POINT_PROPERTIES = {'Event': ('latlng',)}
+
+
+def _split_points(label, rows):
+    """Moves the label's point properties out of each row's properties into
+    a separate points map."""
+    keys = POINT_PROPERTIES.get(label, ())
+    split = []
+    for row in rows:
+        properties = dict(row['properties'])
+        points = {key: properties.pop(key) for key in keys
+                  if key in properties}
+        split.append(dict(row, properties=properties, points=points))
+    return split
+
+
+def _set_points(label):
+    return ''.join(' SET n.{0} = CASE WHEN "{0}" IN keys(row.points) '
+                   'THEN point(row.points.{0}) ELSE n.{0} END'.format(key)
+                   for key in POINT_PROPERTIES.get(label, ()))
+
+
+def create_nodes(graph, label, rows):
+    """Creates one label node per row of {'key', 'properties'} and returns
+    matches of {'key', 'id'} for the new nodes."""
+    name = register('create_nodes:%s' % label,
+                    'UNWIND $rows AS row '
+                    'CREATE (n:%s) SET n = row.properties%s '
+                    'RETURN row.key AS key, ID(n) AS id'
+                    % (label, _set_points(label))).name
+    return run(graph, name, rows=_split_points(label, rows)).data()
+
+
+def update_nodes(graph, label, rows):
+    """Sets properties on label nodes given as rows of {'id', 'properties'},
+    leaving their other properties alone."""
+    name = register('update_nodes:%s' % label,
+                    'UNWIND $rows AS row '
+                    'MATCH (n:%s) WHERE ID(n)=row.id '
+                    'SET n += row.properties%s'
+                    % (label, _set_points(label))).name
+    run(graph, name, rows=_split_points(label, rows))
+
+
+def relate(graph, rel_type, pairs, directed=True):
+    """Creates rel_type relationships between pairs of nodes, given as dicts
+    of start ID, end ID and relationship properties. Existing relationships
+    are kept and have the properties set on them. Undirected relationships
+    match either direction."""
+    if not pairs:
+        return
+    name = register('relate:%s:%s' % (rel_type,
+                                      'directed' if directed else 'undirected'),
+                    'UNWIND $pairs AS pair '
+                    'MATCH (a) WHERE ID(a)=pair.start '
+                    'MATCH (b) WHERE ID(b)=pair.end '
+                    'MERGE (a)-[rel:%s]-%s(b) SET rel += pair.properties'
+                    % (rel_type, '>' if directed else '')).name
+    run(graph, name, pairs=pairs)
+
+
+def unrelate(graph, rel_type, pairs):
+    """Deletes rel_type relationships, in either direction, between pairs of
+    nodes given as dicts of start ID and end ID."""
+    if not pairs:
+        return
+    name = register('unrelate:%s' % rel_type,
+                    'UNWIND $pairs AS pair '
+                    'MATCH (a)-[rel:%s]-(b) '
+                    'WHERE ID(a)=pair.start AND ID(b)=pair.end DELETE rel'
+                    % rel_type).name
+    run(graph, name, pairs=pairs)
+
+
+register('touch_nodes',
+         'UNWIND $ids AS id MATCH (n) WHERE ID(n)=id '
+         'SET n.version = coalesce(n.version, 0) + 1')
+
+
+def touch_nodes(graph, ids):
+    """Bumps the version property of the nodes in ids, which invalidates
+    the ETags served for them."""
+    if ids:
+        run(graph, 'touch_nodes', ids=sorted(ids))
+
+
+register('versions_of',
+         'UNWIND $ids AS id MATCH (n) WHERE ID(n)=id '
+         'RETURN id, coalesce(n.version, 0) AS version')
+
+
+def versions_of(graph, ids):
+    """Returns {node ID: version} for the nodes in ids that exist."""
+    return {m['id']: m['version']
+            for m in run(graph, 'versions_of', ids=list(ids)).data()}
 
 
 def delete_relationships_from(graph, src_id, src_type=None, rel_type=None,
                               dest_type=None):
     """ Deletes relationships of type rel_type connected to node w/ src_id."""
-    query = construct_query(src_type=src_type, src_id=src_id,
-                            rel_type=rel_type, dest_type=dest_type,
-                            action='DELETE', action_entity='rel')
-    graph.run(query)
+    name = construct_query(src_type=src_type, rel_type=rel_type,
+                           dest_type=dest_type, action='DELETE',
+                           action_entity='rel')
+    run(graph, name, src_id=src_id)
+
+
+# Change log. Each entity has at most one Change node {at, entity_id, label,
+# op} (HAS_CHANGE), holding its latest change, which every write to the entity
+# overwrites. A deletion is a Change hung off the people who could see the
+# deleted entity (SEES_CHANGE), so a sync only reads the changes around the
+# caller. `at` is the database's timestamp() in ms; there is no shared
+# counter for writes to contend on. Writers already hold the entity's lock
+# (its version was bumped in the same transaction), so the MERGE cannot race.
+
+register('log_changes',
+         'UNWIND $changes AS change '
+         'MATCH (n) WHERE ID(n)=change.id '
+         'MERGE (n)-[:HAS_CHANGE]->(ch:Change) '
+         'SET ch.at = timestamp(), ch.entity_id = change.id, '
+         'ch.label = head(labels(n)), ch.op = change.op')
+
+
+def log_changes(graph, created, updated):
+    """Records the nodes in created and updated (IDs of existing nodes) as
+    their latest change."""
+    changes = ([{'id': i, 'op': 'created'} for i in sorted(created)] +
+               [{'id': i, 'op': 'updated'} for i in sorted(updated)])
+    if changes:
+        run(graph, 'log_changes', changes=changes)
+
+
+register('change_clock', 'RETURN timestamp()')
+
+
+def change_clock(graph):
+    """Returns the database time, in ms, that change log entries use."""
+    return run(graph, 'change_clock').evaluate()
+
 
+# The entities the person can see (themselves, people they know, their
+# circles and the events they are invited to or that are scheduled in their
+# circles) are expanded from the person, and only their changes, plus the
+# deletions logged for the person, are read. For each entity the last change
+# after the (at, change ID) position is returned; live entities have only one,
+# so the cost grows with the size of the caller's neighbourhood, not with its
+# history.
+register('changes_since',
+         'MATCH (p:Person) WHERE ID(p)=$person_id '
+         'WITH p, [p] + [(p)-[:KNOWS]-(k:Person) | k] + '
+         '[(p)-[:IS_MEMBER]->(c:Circle) | c] + '
+         '[(p)-[:INVITED_TO]->(e:Event) | e] + '
+         '[(p)-[:IS_MEMBER]->(:Circle)-[:SCHEDULED]->(e:Event) | e] '
+         'AS visible '
+         'UNWIND visible AS n '
+         'WITH DISTINCT p, n '
+         'OPTIONAL MATCH (n)-[:HAS_CHANGE]->(ch:Change) '
+         'WHERE ch.at >= $since '
+         'WITH p, collect(ch) AS changes '
+         'UNWIND changes + [(p)-[:SEES_CHANGE]->(ch:Change) '
+         'WHERE ch.at >= $since | ch] AS ch '
+         'WITH ch WHERE ch.at > $since OR ID(ch) > $after '
+         'WITH ch ORDER BY ch.at, ID(ch) '
+         'WITH ch.label AS label, ch.entity_id AS id, last(collect(ch)) AS ch '
+         'OPTIONAL MATCH (n) WHERE ID(n)=id AND label IN labels(n) '
+         'RETURN label, id, ch.op AS op, ch.at AS at, ID(ch) AS change_id, '
+         'coalesce(n.version, 0) AS version '
+         'ORDER BY at, change_id LIMIT $limit')
 
-def delete_node(node, graph):
-    """ Deletes a node and all its relationships from graph."""
+
+def changes_since(graph, person_id, since, after, limit):
+    """Returns up to limit matches of {label, id, op, at, change_id, version}
+    for the entities visible to the person whose last change comes after
+    the position (since, after), in (at, change_id) order."""
+    return run(graph, 'changes_since', person_id=person_id, since=since,
+               after=after, limit=limit).data()
+
+
+def delete_node(node, graph, cascade=None):
+    """Detach-deletes node in a single statement. If cascade is a (rel_type,
+    label) pair, the label nodes node reaches over outgoing rel_type
+    relationships are deleted with it. The remaining neighbours have their
+    versions bumped. The neighbour updates are written to the change log,
+    and each deletion is logged for the people who could see the deleted
+    node, if any; its earlier changes are dropped. Returns the nodes_deleted and
+    relationships_deleted counts, not counting the change log."""
     src_type = type(node).__name__
     src_id = node.__primaryvalue__
+    if cascade:
+        name = 'delete_node:%s:%s:%s' % ((src_type,) + tuple(cascade))
+        dependents = ('OPTIONAL MATCH (src)-[:%s]->(dep:%s) '
+                      'WITH src, collect(DISTINCT dep) AS deps ' % cascade)
+    else:
+        name = 'delete_node:%s' % src_type
+        dependents = 'WITH src, [] AS deps '
+    name = register(
+        name,
+        'MATCH (src:%s) WHERE ID(src)=$src_id ' % src_type + dependents +
+        'WITH [src] + deps AS doomed '
+        'UNWIND doomed AS d '
+        'OPTIONAL MATCH (d)-[rel]-(n) '
+        "WHERE NOT type(rel) IN ['HAS_CHANGE', 'SEES_CHANGE'] "
+        'WITH doomed, collect(DISTINCT rel) AS rels, '
+        "collect(DISTINCT CASE WHEN NOT n IN doomed "
+        "AND type(rel) <> 'SUGGESTED' THEN n END) AS neighbours "
+        'FOREACH (n IN neighbours | '
+        'SET n.version = coalesce(n.version, 0) + 1 '
+        'MERGE (n)-[:HAS_CHANGE]->(ch:Change) '
+        'SET ch.at = timestamp(), ch.entity_id = ID(n), '
+        "ch.label = head(labels(n)), ch.op = 'updated') "
+        'FOREACH (d IN doomed | '
+        'FOREACH (audience IN [[q IN '
+        '[(d)-[:KNOWS|IS_MEMBER|INVITED_TO]-(x:Person) | x] + '
+        '[(d)<-[:SCHEDULED]-(:Circle)<-[:IS_MEMBER]-(x:Person) | x] '
+        'WHERE NOT q IN doomed]] | '
+        'FOREACH (_ IN CASE WHEN size(audience) > 0 THEN [1] ELSE [] END | '
+        'CREATE (ch:Change {at: timestamp(), entity_id: ID(d), '
+        "label: head(labels(d)), op: 'deleted'}) "
+        'FOREACH (q IN audience | MERGE (q)-[:SEES_CHANGE]->(ch))))) '
+        'WITH doomed, rels, neighbours, '
+        'reduce(old = [], d IN doomed | old + '
+        '[(d)-[:HAS_CHANGE]->(c:Change) | c] + '
+        '[(d)-[:SEES_CHANGE]->(c:Change) '
+        'WHERE size((c)<-[:SEES_CHANGE]-()) = 1 | c]) AS old, '
+        '[d IN doomed | ID(d)] AS deleted_ids, '
+        '[n IN neighbours | ID(n)] AS neighbour_ids '
+        'FOREACH (c IN old | DETACH DELETE c) '
+        'FOREACH (d IN doomed | DETACH DELETE d) '
+        'RETURN deleted_ids, neighbour_ids, '
+        'size(deleted_ids) AS nodes_deleted, '
+        'size(rels) AS relationships_deleted').name
+
+    counts = {'nodes_deleted': 0, 'relationships_deleted': 0}
+    for m in run(graph, name, src_id=src_id).data():
+        doc_cache.invalidate(m['deleted_ids'] + m['neighbour_ids'])
+        counts = {key: m[key] for key in counts}
+    return counts
+
+
+# Sharing neighbours over these relationship types makes two people likely to
+# know each other. {rel_type: (label of the shared node, SUGGESTED property)}
+SUGGESTION_SIGNALS = {'KNOWS': ('Person', 'mutual_friends'),
+                      'IS_MEMBER': ('Circle', 'shared_circles')}
+# Shared nodes with more people than this do not count towards suggestions:
+# they say little about who knows whom, and keeping their pairs current would
+# cost O(size) writes for every person joining or leaving them.
+SUGGESTION_HUB_LIMIT = 250
+# Appended to statements that change the signal counts on SUGGESTED rel.
+_SCORE_SUGGESTION = ('SET rel.score = 2 * coalesce(rel.mutual_friends, 0) '
+                     '+ coalesce(rel.shared_circles, 0) '
+                     'WITH rel WHERE rel.score <= 0 DELETE rel')
+
+
+def adjust_suggestions(graph, rel_type, hubs):
+    """Updates suggestion scores after rel_type relationships changed. hubs
+    are dicts of a shared node ID and the IDs of the people added to and
+    removed from it, with the changes already applied to the graph. Each
+    pair of people that gains (or loses) the hub as a shared neighbour gains
+    (or loses) one point of its signal, as long as the hub has at most
+    SUGGESTION_HUB_LIMIT people. A hub crossing the limit takes away (or
+    gives back) the points of all its pairs once."""
+    if not hubs:
+        return
+    label, prop = SUGGESTION_SIGNALS[rel_type]
+    name = register(
+        'adjust_suggestions:%s' % rel_type,
+        'UNWIND $hubs AS row '
+        'MATCH (h:%s) WHERE ID(h)=row.hub '
+        'OPTIONAL MATCH (h)-[:%s]-(k:Person) '
+        'WHERE NOT ID(k) IN row.added + row.removed '
+        'WITH row, collect(DISTINCT ID(k)) AS kept '
+        'WITH row, kept, size(kept) + size(row.removed) <= $limit AS was_on, '
+        'size(kept) + size(row.added) <= $limit AS is_on '
+        'UNWIND CASE WHEN was_on AND is_on THEN '
+        'reduce(acc = [], x IN row.added | acc + '
+        '[y IN kept + [z IN row.added WHERE z > x] | [x, y, 1]]) + '
+        'reduce(acc = [], x IN row.removed | acc + '
+        '[y IN kept + [z IN row.removed WHERE z > x] | [x, y, -1]]) '
+        'WHEN was_on THEN reduce(acc = [], x IN kept + row.removed | acc + '
+        '[y IN kept + row.removed WHERE y > x | [x, y, -1]]) '
+        'WHEN is_on THEN reduce(acc = [], x IN kept + row.added | acc + '
+        '[y IN kept + row.added WHERE y > x | [x, y, 1]]) '
+        'ELSE [] END AS d '
+        'MATCH (x:Person), (y:Person) WHERE ID(x)=d[0] AND ID(y)=d[1] '
+        'UNWIND [[x, y], [y, x]] AS pair '
+        'WITH pair[0] AS a, pair[1] AS b, d[2] AS delta '
+        'MERGE (a)-[rel:SUGGESTED]->(b) '
+        'SET rel.{0} = coalesce(rel.{0}, 0) + delta '.format(prop)
+        % (label, rel_type) + _SCORE_SUGGESTION).name
+    run(graph, name, hubs=hubs, limit=SUGGESTION_HUB_LIMIT)
+
+
+def drop_suggestion_hub(graph, rel_type, hub_id):
+    """Takes away the point every pair of people related to the hub over
+    rel_type has for sharing it, unless it is over SUGGESTION_HUB_LIMIT and
+    gave none. Run before the hub is deleted."""
+    label, prop = SUGGESTION_SIGNALS[rel_type]
+    name = register(
+        'drop_suggestion_hub:%s' % rel_type,
+        'MATCH (h:%s)-[:%s]-(x:Person) WHERE ID(h)=$hub_id '
+        'WITH collect(DISTINCT x) AS people '
+        'WHERE size(people) <= $limit '
+        'UNWIND people AS a UNWIND people AS b '
+        'MATCH (a)-[rel:SUGGESTED]->(b) '
+        'SET rel.{0} = rel.{0} - 1 '.format(prop) % (label, rel_type)
+        + _SCORE_SUGGESTION).name
+    run(graph, name, hub_id=hub_id, limit=SUGGESTION_HUB_LIMIT)
+
+
+register('suggestions_for',
+         'MATCH (p:Person)-[rel:SUGGESTED]->(q:Person) '
+         'WHERE ID(p)=$person_id AND NOT (p)-[:KNOWS]-(q) '
+         'RETURN q AS person, '
+         'coalesce(rel.mutual_friends, 0) AS mutual_friends, '
+         'coalesce(rel.shared_circles, 0) AS shared_circles '
+         'ORDER BY rel.score DESC, ID(q) LIMIT $limit')
+
+
+def suggestions_for(graph, person_id, limit):
+    """Returns up to limit matches of {'person', 'mutual_friends',
+    'shared_circles'} for people the person does not know yet, best first."""
+    return run(graph, 'suggestions_for', person_id=person_id,
+               limit=limit).data()
+
+
+register('clear_suggestions', 'MATCH ()-[rel:SUGGESTED]->() DELETE rel')
+register('score_suggestions',
+         'MATCH ()-[rel:SUGGESTED]->() ' + _SCORE_SUGGESTION)
 
-    # Delete all relationships.
-    delete_rels_query = construct_query(src_type=src_type, src_id=src_id,
-                                        action='DELETE', action_entity='rel')
-    # Delete node itself.
-    delete_node_query = Template(
-        'MATCH(src: $src_type) WHERE ID(src)=$src_id DELETE src'
-    ).substitute(src_type=src_type, src_id=src_id)
 
-    graph.run(delete_rels_query)
-    graph.run(delete_node_query)
+def rebuild_suggestions(graph):
+    """Recomputes every suggestion score from scratch in one transaction.
+    Scores are kept up to date incrementally, so this is only needed to
+    backfill them."""
+    with transaction(graph) as tx:
+        run(tx, 'clear_suggestions')
+        for rel_type, (label, prop) in sorted(SUGGESTION_SIGNALS.items()):
+            name = register(
+                'rebuild_suggestions:%s' % rel_type,
+                'MATCH (h:{1})-[:{0}]-(k:Person) '
+                'WITH h, count(DISTINCT k) AS size WHERE size <= $limit '
+                'MATCH (a:Person)-[:{0}]-(h)-[:{0}]-(b:Person) '
+                'WHERE a <> b WITH a, b, count(DISTINCT h) AS n '
+                'MERGE (a)-[rel:SUGGESTED]->(b) '
+                'SET rel.{2} = n'.format(rel_type, label, prop)).name
+            run(tx, name, limit=SUGGESTION_HUB_LIMIT)
+        run(tx, 'score_suggestions')
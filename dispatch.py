@@ -0,0 +1,77 @@
+"""
+Background dispatch of slow side effects (push notifications) off the request
+path. Handlers enqueue a job and return immediately; a bounded pool of worker
+threads drains the queue and retries failed jobs with exponential backoff.
+"""
+import queue
+import threading
+import time
+
+
+class Dispatcher(object):
+    """Runs send(*args, **kwargs) jobs on up to `workers` daemon threads.
+
+    A job that raises is retried up to `retries` times, sleeping
+    backoff * 2 ** attempt seconds in between, but only while
+    `retry_if(exception)` is true; by default every exception is retried.
+    When the queue already holds `max_queue` jobs, new jobs are dropped
+    rather than blocking the request.
+    """
+
+    def __init__(self, send, workers=4, max_queue=1000, retries=3,
+                 backoff=0.5, retry_if=lambda x: True, sleep=time.sleep):
+        self.send = send
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.retry_if = retry_if
+        self.sleep = sleep
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def submit(self, *args, **kwargs):
+        """Enqueues a job. Returns False if the queue is full."""
+        self._ensure_started()
+        try:
+            self._queue.put_nowait((args, kwargs))
+            return True
+        except queue.Full:
+            print('Dispatch queue full; dropping job.')
+            return False
+
+    def join(self):
+        """Blocks until every job enqueued so far has finished."""
+        self._queue.join()
+
+    def _ensure_started(self):
+        if self._threads:
+            return
+        with self._lock:
+            while len(self._threads) < self.workers:
+                t = threading.Thread(target=self._work, daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def _work(self):
+        while True:
+            args, kwargs = self._queue.get()
+            try:
+                self._run(args, kwargs)
+            finally:
+                self._queue.task_done()
+
+    def _run(self, args, kwargs):
+        for attempt in range(self.retries + 1):
+            try:
+                self.send(*args, **kwargs)
+                return
+            except Exception as x:
+                if not self.retry_if(x):
+                    print('Dispatch failed permanently: ' + str(x))
+                    return
+                if attempt == self.retries:
+                    print('Dispatch failed after {} attempts: {}'
+                          .format(attempt + 1, x))
+                    return
+                self.sleep(self.backoff * 2 ** attempt)
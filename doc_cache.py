@@ -0,0 +1,133 @@
+"""
+Cache for serialized Circle and Event documents.
+
+Documents are stored per node ID together with the node's version (see
+UnitOfWork in Models), and a lookup only hits if the version it asks for is
+the one stored. Every change bumps the version, and new nodes start from a
+random one (Models.new_version), so an entry left behind by a missed
+invalidation, here or in another instance's cache, is not served for a later
+version of the node, or for a new node that reuses a deleted node's ID,
+unless their 48-bit random versions happen to collide. The write paths still
+invalidate what they touch so dead entries do not linger.
+
+The cache lives in-process by default. Setting CIRCLES_DOC_CACHE_URL to a
+redis:// URL shares it between instances instead; that needs the redis
+package, which is not in requirements.txt.
+"""
+import json
+import os
+import time
+from collections import OrderedDict
+from threading import Lock
+
+CACHE_URL_ENV = 'CIRCLES_DOC_CACHE_URL'
+
+
+class LRUBackend(object):
+    """In-process cache holding at most max_entries documents."""
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # {node ID: (version, document)}
+        self._lock = Lock()
+
+    def get(self, node_id):
+        with self._lock:
+            entry = self._entries.get(node_id)
+            if entry is not None:
+                self._entries.move_to_end(node_id)
+            return entry
+
+    def set(self, node_id, version, doc):
+        with self._lock:
+            self._entries[node_id] = (version, doc)
+            self._entries.move_to_end(node_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, node_ids):
+        with self._lock:
+            for node_id in node_ids:
+                self._entries.pop(node_id, None)
+
+
+class SharedBackend(object):
+    """Cache in a key-value store shared by all instances. client needs
+    redis-style get(key), set(key, value, ex=seconds) and delete(*keys)."""
+
+    def __init__(self, client, prefix='circles:doc:', ttl=24 * 3600):
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def _key(self, node_id):
+        return '%s%d' % (self.prefix, node_id)
+
+    def get(self, node_id):
+        value = self.client.get(self._key(node_id))
+        if value is None:
+            return None
+        version, doc = json.loads(value)
+        return version, doc
+
+    def set(self, node_id, version, doc):
+        self.client.set(self._key(node_id), json.dumps([version, doc]),
+                        ex=self.ttl)
+
+    def delete(self, node_ids):
+        keys = [self._key(node_id) for node_id in node_ids]
+        if keys:
+            self.client.delete(*keys)
+
+
+class LocalClient(object):
+    """Stands in for a redis client in SharedBackend, e.g. in benchmarks."""
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self._values = {}  # {key: (value, expiry)}
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            value, expiry = self._values.get(key, (None, None))
+            if expiry is not None and expiry <= self.clock():
+                del self._values[key]
+                return None
+            return value
+
+    def set(self, key, value, ex=None):
+        with self._lock:
+            self._values[key] = (value, self.clock() + ex if ex else None)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._values.pop(key, None)
+
+
+def _default_backend():
+    url = os.environ.get(CACHE_URL_ENV)
+    if not url:
+        return LRUBackend()
+    import redis
+    return SharedBackend(redis.Redis.from_url(url))
+
+
+backend = _default_backend()
+
+
+def get(node_id, version):
+    """Returns the cached document of node_id at version, or None."""
+    entry = backend.get(node_id)
+    if entry is None or entry[0] != (version or 0):
+        return None
+    return entry[1]
+
+
+def put(node_id, version, doc):
+    backend.set(node_id, version or 0, doc)
+
+
+def invalidate(node_ids):
+    backend.delete(list(node_ids))
@@ -0,0 +1,124 @@
+"""
+Per-request Neo4j query counting and timing.
+
+install(graph) wraps the graph's round-trip methods (run, evaluate, push,
+match and the run method of transactions from begin). GraphObject.match
+lookups and Related attribute loads all go through these on the same graph
+object, so they are counted too. Flask hooks in main call start_request and
+finish_request around every request.
+"""
+import functools
+import threading
+import time
+
+# Upper bounds of the histogram buckets; the last bucket is unbounded.
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250)
+
+WRAPPED_METHODS = ('run', 'evaluate', 'push', 'match')
+
+_local = threading.local()
+
+
+class RequestStats(object):
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.neo4j_ms = 0.0
+        self.depth = 0
+
+    @property
+    def elapsed_ms(self):
+        return (time.perf_counter() - self.start) * 1000
+
+
+def _timed(method):
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        stats = getattr(_local, 'stats', None)
+        if stats is None or stats.depth:
+            # Outside a request, or nested inside a call already counted.
+            return method(*args, **kwargs)
+        stats.depth += 1
+        start = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            stats.depth -= 1
+            stats.queries += 1
+            stats.neo4j_ms += (time.perf_counter() - start) * 1000
+    return wrapper
+
+
+def install(graph):
+    """Wraps graph's round-trip methods in place and returns graph."""
+    if getattr(graph, '_instrumented', False):
+        return graph
+    for name in WRAPPED_METHODS:
+        if hasattr(graph, name):
+            setattr(graph, name, _timed(getattr(graph, name)))
+    if hasattr(graph, 'begin'):
+        begin = graph.begin
+
+        @functools.wraps(begin)
+        def instrumented_begin(*args, **kwargs):
+            tx = begin(*args, **kwargs)
+            tx.run = _timed(tx.run)
+            return tx
+        graph.begin = instrumented_begin
+    graph._instrumented = True
+    return graph
+
+
+def start_request():
+    _local.stats = RequestStats()
+
+
+def finish_request():
+    """Returns the current request's RequestStats and stops recording."""
+    stats = getattr(_local, 'stats', None)
+    _local.stats = None
+    return stats
+
+
+def current():
+    return getattr(_local, 'stats', None)
+
+
+def _bucket(value, bounds):
+    for bound in bounds:
+        if value <= bound:
+            return str(bound)
+    return '+Inf'
+
+
+class RouteStats(object):
+    """Aggregates request latency and query-count histograms per route."""
+
+    def __init__(self):
+        self._routes = {}
+        self._lock = threading.Lock()
+
+    def record(self, route, stats):
+        elapsed_ms = stats.elapsed_ms
+        with self._lock:
+            route_stats = self._routes.setdefault(route, {
+                'count': 0, 'queries': 0, 'total_ms': 0.0, 'neo4j_ms': 0.0,
+                'latency_ms': {}, 'queries_per_request': {}})
+            route_stats['count'] += 1
+            route_stats['queries'] += stats.queries
+            route_stats['total_ms'] += elapsed_ms
+            route_stats['neo4j_ms'] += stats.neo4j_ms
+            for key, value, bounds in (
+                    ('latency_ms', elapsed_ms, LATENCY_BUCKETS_MS),
+                    ('queries_per_request', stats.queries, QUERY_BUCKETS)):
+                bucket = _bucket(value, bounds)
+                route_stats[key][bucket] = route_stats[key].get(bucket, 0) + 1
+
+    def snapshot(self):
+        with self._lock:
+            return {route: dict(s, latency_ms=dict(s['latency_ms']),
+                                queries_per_request=dict(
+                                    s['queries_per_request']))
+                    for route, s in self._routes.items()}
@@ -1,15 +1,21 @@
 """
 Main driver for Flask server.
 """
-from Models import Person, Circle, Event, GraphError
-from py2neo import Graph
+from Models import (Person, Circle, Event, ConflictError, GraphError,
+                    parse_latlng, parse_time)
 from flask import (Flask, abort, jsonify, render_template, request)
-from pyfcm import FCMNotification
 import notif_manager
 import auth
+import authz
+import cypher
+import instrument
+import pagination
+import pool
+import schema
 import os
 import json
-from itertools import combinations
+from datetime import datetime, timedelta
+from collections import OrderedDict
 import firebase_admin
 from firebase_admin import credentials, auth as fb_auth, _auth_utils as a_util
 firebase_admin.initialize_app()
@@ -19,19 +25,80 @@ CIRCLES = 'circles'
 CIRCLE = 'circle'
 EVENTS = 'events'
 PEOPLE = 'people'
+FEED = 'feed'
+FEED_DAYS = 30
+SUGGESTIONS = 'suggestions'
+SUGGESTIONS_LIMIT = 10
+SYNC_LABELS = OrderedDict([('Person', 'People'), ('Circle', 'Circles'),
+                           ('Event', 'Events')])
+# Sync tokens are rewound this far behind the database clock, so changes
+# from transactions that committed after a sync read past their timestamp
+# are picked up by the next one.
+SYNC_OVERLAP_MS = 10000
+MAX_BATCH = 500
+NEARBY_RADIUS = 5000  # meters
+MAX_NEARBY_RADIUS = 100000
 SUCCESS_JSON = json.dumps({'success': True}), 200, {
     'ContentType': 'application/json'
 }
 
 app = Flask(__name__)
 
-# Setup push notifications
-push_service = FCMNotification(api_key=auth.fcm_creds())
-
-# Connect to Neo4j graph.
-host, username, password = auth.neo4j_creds()
-graph = Graph(host=host, username=username,
-              password=password, secure=True)
+# The shared Neo4j graph, with py2neo's connection pool sized to match the
+# number of requests allowed to use it at once.
+POOL_SIZE = int(os.environ.get('NEO4J_POOL_SIZE', 8))
+graph_pool = pool.GraphPool(
+    lambda: instrument.install(auth.connect_graph(POOL_SIZE)),
+    size=POOL_SIZE,
+    timeout=float(os.environ.get('NEO4J_POOL_TIMEOUT', 10)))
+graph = pool.PooledGraph(graph_pool)
+
+# Per-route latency and query histograms, served by /debug/stats if enabled.
+route_stats = instrument.RouteStats()
+DEBUG_STATS = os.environ.get('CIRCLES_DEBUG_STATS') == '1'
+
+# Cache verified ID tokens so repeat requests skip verification and lookup.
+token_cache = auth.TokenCache()
+
+
+@app.before_first_request
+def bootstrap_schema():
+    for kind, label, key, status in schema.ensure_schema(graph):
+        if status not in ('exists', 'created'):
+            print('Schema {} :{}({}) {}'.format(kind, label, key, status))
+
+
+@app.before_request
+def start_instrumentation():
+    instrument.start_request()
+    authz.start_request()
+    graph_pool.start_request()
+
+
+@app.teardown_request
+def release_graph(error=None):
+    graph_pool.finish_request()
+
+
+@app.after_request
+def report_instrumentation(response):
+    authz.finish_request()
+    stats = instrument.finish_request()
+    if stats is None:
+        return response
+    rule = request.url_rule.rule if request.url_rule else '<unmatched>'
+    route = '{} {}'.format(request.method, rule)
+    elapsed_ms = stats.elapsed_ms
+    response.headers['Server-Timing'] = (
+        'neo4j;dur={:.1f};desc="{} queries", app;dur={:.1f}'
+        .format(stats.neo4j_ms, stats.queries, elapsed_ms))
+    route_stats.record(route, stats)
+    print(json.dumps({'severity': 'INFO', 'message': 'request',
+                      'route': route, 'status': response.status_code,
+                      'queries': stats.queries,
+                      'neo4j_ms': round(stats.neo4j_ms, 1),
+                      'elapsed_ms': round(elapsed_ms, 1)}))
+    return response
 
 
 """
@@ -53,17 +120,35 @@ def person(person_id, resource=None):
     if request.method == 'GET':
         if not resource:
             if self_req:
-                return jsonify(person.json_repr(graph))
+                return conditional_json(
+                    person, lambda: person.json_repr(graph), 'full')
             else:
-                return jsonify(person.json_repr_lim())
+                return conditional_json(person, person.json_repr_lim)
         # Request specific resource associated with the person if they are authorized
         if self_req:
+            limit, position = page_request()
             if resource == CIRCLES:
-                return jsonify([c.json_repr(graph) for c in person.IsMember])
+                circle_ids, next_position = Person.circles_page_of(
+                    graph, person_id, limit, position)
+                return paged(Circle.json_repr_many(graph, circle_ids),
+                             next_position)
             elif resource == EVENTS:
-                return jsonify([e.json_repr(graph) for e in person.InvitedTo])
+                event_ids, next_position = Person.events_page_of(
+                    graph, person_id, limit, position, *event_window())
+                return paged(Event.json_repr_many(graph, event_ids),
+                             next_position)
             elif resource == PEOPLE:
-                return jsonify([k.json_repr_lim() for k in person.Knows])
+                people, next_position = Person.people_page_of(
+                    graph, person_id, limit, position)
+                return paged([k.json_repr_lim() for k in people],
+                             next_position)
+            elif resource == FEED:
+                start, end = time_window(FEED_DAYS)
+                return jsonify(Person.feed_of(graph, person_id, start, end))
+            elif resource == SUGGESTIONS:
+                if 'limit' not in request.args:
+                    limit = SUGGESTIONS_LIMIT
+                return jsonify(Person.suggestions_for(graph, person_id, limit))
             abort(404, description='Invalid resource specified')
         abort(403, description='Unauthorized resource access')
 
@@ -80,20 +165,25 @@ def person(person_id, resource=None):
                 # Get the actual people corresponding to the new ID's.
                 newly_added_people = [p for p in to_person.Knows if
                                       p.__primaryvalue__ in newly_added_ids]
+                if to_person.email != person.email:
+                    token_cache.invalidate_person(person_id)
                 person.update_to(graph, to_person)
                 notif_manager.send_add_person_notif(
                     graph, req_user, newly_added_people)
                 return SUCCESS_JSON
             except KeyError as e:
                 bad_request('Request JSON must include key %s' % e)
+            except ConflictError as e:
+                abort(409, description=str(e))
             except GraphError as e:
                 bad_request(e)
         abort(403, description='Unauthorized modification request')
 
     elif request.method == 'DELETE':
         if self_req:
-            person.delete(graph)
-            return SUCCESS_JSON
+            deleted = person.delete(graph)
+            token_cache.invalidate_person(person_id)
+            return jsonify(success=True, **deleted)
         abort(403, description='Unauthorized deletion request')
 
 
@@ -110,8 +200,7 @@ def circle(circle_id, resource=None):
         abort(404, description='Resource not found')
     # Determine if user that is requesting the circle has privilege to see it
     owner_req = req_user.__primaryvalue__ == circle.owner_id
-    member_req = circle_id in list(
-        c.__primaryvalue__ for c in req_user.IsMember)
+    member_req = authz.is_member(graph, req_user.__primaryvalue__, circle_id)
     if not member_req:
         abort(403, description='Unauthorized circle get')
 
@@ -119,7 +208,8 @@ def circle(circle_id, resource=None):
         if member_req:
             if not resource:
                 # Request specific circle
-                return jsonify(circle.json_repr(graph))
+                return conditional_json(circle,
+                                        lambda: circle.json_repr(graph))
             # Request specific resource associated with the circle
             if resource == PEOPLE:
                 return jsonify([
@@ -127,7 +217,10 @@ def circle(circle_id, resource=None):
                     for m in Circle.members_of(graph, circle_id)
                 ])
             elif resource == EVENTS:
-                return jsonify([e.json_repr(graph) for e in circle.Scheduled])
+                event_ids, next_position = Circle.events_page_of(
+                    graph, circle_id, *(page_request() + event_window()))
+                return paged(Event.json_repr_many(graph, event_ids),
+                             next_position)
             abort(404, description='Invalid resource specified')
         abort(403, description='Unauthorized circle request')
 
@@ -165,8 +258,7 @@ def circle(circle_id, resource=None):
 
     elif request.method == 'DELETE':
         if owner_req:
-            circle.delete(graph)
-            return SUCCESS_JSON
+            return jsonify(success=True, **circle.delete(graph))
         abort(403, description='Unauthorized circle request')
         # Only the owner may delete a circle
 
@@ -182,14 +274,14 @@ def event(event_id, resource=None):
     # Fetch the person making the request
     req_user = auth_get_req_user(request)
     owner_req = req_user.__primaryvalue__ == event.owner_id
-    guest_req = event_id in list(
-        e.__primaryvalue__ for e in req_user.InvitedTo)
+    guest_req = authz.is_invited(graph, req_user.__primaryvalue__, event_id)
 
     if request.method == 'GET':
         if owner_req or guest_req:  # access is authorized
             if not resource:
                 # Request specific event.
-                    return jsonify(event.json_repr(graph))
+                    return conditional_json(event,
+                                            lambda: event.json_repr(graph))
                 # Request specific resource associated with the event
             if resource in [CIRCLE, CIRCLES]:
                 return jsonify(
@@ -214,8 +306,7 @@ def event(event_id, resource=None):
 
     elif request.method == 'DELETE':
         if owner_req:
-            event.delete(graph)
-            return SUCCESS_JSON
+            return jsonify(success=True, **event.delete(graph))
         abort(403, description='Unauthorized event deletion request')
 
 
@@ -237,6 +328,8 @@ def post_user():
         return SUCCESS_JSON
     except KeyError as e:
         bad_request('Request JSON must include key %s' % e)
+    except ConflictError as e:
+        abort(409, description=str(e))
 
 
 @app.route('/circles/api/v1.0/circles', methods=['POST'])
@@ -275,8 +368,8 @@ def post_event():
     if not circle:
         abort(404, description='Invalid Circle Specified')
     owner_req = req_user.__primaryvalue__ == circle.owner_id
-    member_req = circle.__primaryvalue__ in list(
-        c.__primaryvalue__ for c in req_user.IsMember)
+    member_req = authz.is_member(graph, req_user.__primaryvalue__,
+                                 circle.__primaryvalue__)
     member_valid_ping = owner_req or (member_req and circle.members_can_ping)
     if owner_req or member_valid_ping:
         try:
@@ -291,6 +384,108 @@ def post_event():
     abort(403, description='Insufficient Permissions')
 
 
+@app.route('/circles/api/v1.0/batch', methods=['GET'])
+def batch():
+    """
+    Documents for many entities in one request, e.g.
+    /batch?people=1,2&circles=3&events=4,5
+    Entities that do not exist or that the requester may not see are left
+    out, with the same rules as the single-entity routes.
+    """
+    req_user = auth_get_req_user(request)
+    req_id = req_user.__primaryvalue__
+    person_ids = id_list(PEOPLE)
+    circle_ids = id_list(CIRCLES)
+    event_ids = id_list(EVENTS)
+    own = cypher.person_relationships(graph, req_id)
+
+    people = Person.json_repr_lim_many(
+        graph, [p_id for p_id in person_ids if p_id != req_id])
+    if req_id in person_ids:
+        people.insert(person_ids.index(req_id), req_user.json_repr(graph))
+    member_of = set(own['circles'])
+    invited_to = set(e_id for e_id, _ in own['events'])
+    circles = Circle.json_repr_many(
+        graph, [c_id for c_id in circle_ids if c_id in member_of])
+    events = [e for e in Event.json_repr_many(graph, event_ids)
+              if e['id'] in invited_to or e['owner_id'] == req_id]
+    return jsonify(People=people, Circles=circles, Events=events)
+
+
+@app.route('/circles/api/v1.0/sync', methods=['GET'])
+def sync():
+    """
+    Entities created, updated or deleted since a sync token, e.g.
+    /sync?since=<Token from the last response>
+    Returns {"People", "Circles", "Events"} with the current documents of
+    created and updated entities the requester can see, "Deleted" with the
+    IDs of deleted ones by kind, and the next "Token". Without since, only
+    the current token is returned, to take before a full download. If
+    "More" is true, there are further changes; sync again with the token.
+    Changes from the last SYNC_OVERLAP_MS may be returned twice.
+    """
+    req_user = auth_get_req_user(request)
+    req_id = req_user.__primaryvalue__
+    rewound = {'at': cypher.change_clock(graph) - SYNC_OVERLAP_MS, 'id': -1}
+    if 'since' not in request.args:
+        return jsonify(Token=pagination.encode(rewound))
+    try:
+        position = pagination.decode(request.args['since'])
+        since, after = int(position['at']), int(position['id'])
+        limit = pagination.parse_limit(request.args.get('limit'))
+    except (KeyError, TypeError, ValueError):
+        bad_request('since must be a token returned by /sync.')
+
+    matches = cypher.changes_since(graph, req_id, since, after, limit)
+    changed = {label: {} for label in SYNC_LABELS}  # {label: {ID: version}}
+    deleted = {label: [] for label in SYNC_LABELS}
+    for m in matches:
+        if m['op'] == 'deleted':
+            deleted[m['label']].append(m['id'])
+        else:
+            changed[m['label']][m['id']] = m['version']
+
+    people = Person.json_repr_lim_many(
+        graph, [p_id for p_id in changed['Person'] if p_id != req_id])
+    if req_id in changed['Person']:
+        people.insert(0, req_user.json_repr(graph))
+    more = len(matches) == limit
+    token = ({'at': matches[-1]['at'], 'id': matches[-1]['change_id']}
+             if more else rewound)
+    return jsonify(
+        People=people,
+        Circles=Circle.json_repr_many(graph, list(changed['Circle']),
+                                      changed['Circle']),
+        Events=Event.json_repr_many(graph, list(changed['Event']),
+                                    changed['Event']),
+        Deleted={kind: deleted[label] for label, kind in SYNC_LABELS.items()},
+        Token=pagination.encode(token),
+        More=more)
+
+
+@app.route('/circles/api/v1.0/events/nearby', methods=['GET'])
+def nearby_events():
+    """
+    Events in the requester's circles within radius meters of a point,
+    nearest first, e.g. /events/nearby?lat=37.43&lng=-122.17&radius=2000
+    Takes the limit, from, to and upcoming parameters of the event lists.
+    """
+    req_user = auth_get_req_user(request)
+    try:
+        center = parse_latlng([request.args['lat'], request.args['lng']])
+        radius = float(request.args.get('radius', NEARBY_RADIUS))
+        limit = pagination.parse_limit(request.args.get('limit'))
+    except KeyError as e:
+        bad_request('Query must include %s' % e)
+    except ValueError as e:
+        bad_request(str(e))
+    if not 0 < radius <= MAX_NEARBY_RADIUS:
+        bad_request('radius must be between 0 and %d meters.'
+                    % MAX_NEARBY_RADIUS)
+    return jsonify(Event.nearby(graph, req_user.__primaryvalue__, center,
+                                radius, limit, *event_window()))
+
+
 """
 Other routes and helper functions.
 """
@@ -302,25 +497,138 @@ def getid():
     return str(req_user.__primaryvalue__)
 
 
+@app.route('/circles/api/v1.0/debug/stats', methods=['GET'])
+def debug_stats():
+    """Per-route histograms and per-query timings. Only served when the
+    CIRCLES_DEBUG_STATS environment variable is 1."""
+    if not DEBUG_STATS:
+        abort(404, description='Resource not found')
+    return jsonify(routes=route_stats.snapshot(),
+                   queries=cypher.query_stats(),
+                   pool=graph_pool.stats())
+
+
+@app.errorhandler(pool.PoolTimeout)
+def busy(e):
+    return jsonify(error=str(e)), 503, {'Retry-After': '1'}
+
+
 @app.errorhandler(400)
 @app.errorhandler(404)
 def error(e):
     return jsonify(error=str(e))
 
 
+@app.errorhandler(409)
+def conflict(e):
+    return jsonify(error=e.description), 409
+
+
 def bad_request(msg):
     abort(400, description=msg)
 
 
+def id_list(name):
+    """Parses the comma-separated IDs in query parameter name, dropping
+    repeats."""
+    try:
+        ids = [int(i) for i in request.args.get(name, '').split(',') if i]
+    except ValueError:
+        bad_request('%s must be comma-separated IDs.' % name)
+    if len(ids) > MAX_BATCH:
+        bad_request('At most %d %s per request.' % (MAX_BATCH, name))
+    return list(OrderedDict.fromkeys(ids))
+
+
+def query_time(name):
+    """Parses the ISO 8601 time in query parameter name, if present."""
+    if name not in request.args:
+        return None
+    try:
+        return parse_time(request.args[name])
+    except ValueError as e:
+        bad_request(str(e))
+
+
+def time_window(days):
+    """Returns the ISO 8601 start and end of the window given by the from
+    and to query parameters, defaulting to the next `days` days."""
+    start = query_time('from') or datetime.utcnow().replace(microsecond=0)
+    end = query_time('to') or start + timedelta(days=days)
+    return start.isoformat(), end.isoformat()
+
+
+def event_window():
+    """Returns the bounds on event start times given by the from, to and
+    upcoming query parameters, as ISO 8601 strings or None if open."""
+    since, until = query_time('from'), query_time('to')
+    if since is None and request.args.get('upcoming') in ('1', 'true'):
+        since = datetime.utcnow().replace(microsecond=0)
+    return (since.isoformat() if since else None,
+            until.isoformat() if until else None)
+
+
+def page_request():
+    """Returns the page size and cursor position from the query string. The
+    position's ID and start time, if any, are checked before they reach a
+    query."""
+    try:
+        limit = pagination.parse_limit(request.args.get('limit'))
+        position = pagination.decode(request.args.get('cursor'))
+        if 'id' in position and (not isinstance(position['id'], int) or
+                                 isinstance(position['id'], bool)):
+            raise ValueError('Invalid cursor.')
+        if 'start' in position:
+            try:
+                position['start'] = parse_time(
+                    position['start']).isoformat()
+            except ValueError:
+                raise ValueError('Invalid cursor.')
+    except ValueError as e:
+        bad_request(str(e))
+    return limit, position
+
+
+def paged(items, next_position):
+    """JSON list response with the next page's cursor in X-Next-Cursor."""
+    response = jsonify(items)
+    if next_position is not None:
+        response.headers['X-Next-Cursor'] = pagination.encode(next_position)
+    return response
+
+
+def conditional_json(obj, render, variant=''):
+    """JSON response for obj tagged with an ETag from its version. If the
+    client already has that version, answers 304 without calling render."""
+    tag = '%s-%d-%d' % (type(obj).__name__.lower(), obj.__primaryvalue__,
+                        obj.version or 0)
+    if variant:
+        tag += '-' + variant
+    if tag in request.if_none_match:
+        response = app.response_class(status=304)
+    else:
+        response = jsonify(render())
+    response.set_etag(tag)
+    return response
+
+
 def auth_get_req_user(request):
     """Gets the Person node associated with entity making the request."""
     # Fetch the person making the request
     req_token = request.headers.get('Authorization')
+    person_id = token_cache.get(req_token)
+    if person_id is not None:
+        req_user = Person.match(graph, person_id).first()
+        if req_user:
+            return req_user
+        token_cache.invalidate_person(person_id)
     try:
         decoded_token = fb_auth.verify_id_token(req_token)
         req_email = decoded_token['email']
-        req_user = (Person.match(graph).where(
-            "_.email = '{}'".format(req_email))).first()
+        req_user = Person.by_email(graph, req_email)
+        if req_user:
+            token_cache.put(req_token, req_user.__primaryvalue__,
+                            decoded_token['exp'])
         return req_user
     except a_util.InvalidIdTokenError:
         bad_request('Invalid authorization attempt.')
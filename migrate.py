@@ -0,0 +1,74 @@
+"""
+One-off data migrations, run by hand against the configured graph:
+
+    python migrate.py event_locations
+    python migrate.py event_times
+    python migrate.py suggestions
+"""
+import argparse
+
+import auth
+import cypher
+from Models import UnitOfWork, parse_latlng, parse_time
+
+EVENT_TIMES = ('start_datetime', 'end_datetime', 'created_at')
+
+
+def _convert_events(graph, fetch, convert, batch):
+    """Pages through events with fetch(graph, after, limit) and updates each
+    with the properties convert(match) returns, if any, batch events per
+    transaction. Events convert raises ValueError on are skipped."""
+    after = -1
+    while True:
+        matches = fetch(graph, after, batch)
+        if not matches:
+            return
+        uow = UnitOfWork()
+        for m in matches:
+            try:
+                properties = convert(m)
+            except ValueError as x:
+                print('Skipping event %d: %s' % (m['id'], x))
+                continue
+            if properties:
+                uow.update('Event', m['id'], properties)
+        uow.commit(graph)
+        after = matches[-1]['id']
+
+
+def event_times(graph, batch=1000):
+    """Converts Event times stored as ISO 8601 strings to Neo4j temporal
+    values."""
+    _convert_events(graph, cypher.event_times, lambda m: {
+        key: parse_time(m[key]) for key in EVENT_TIMES
+        if isinstance(m[key], str)}, batch)
+
+
+def event_locations(graph, batch=1000):
+    """Converts Event locations stored as strings or lists to points."""
+    _convert_events(graph, cypher.event_locations, lambda m: (
+        {'latlng': parse_latlng(m['latlng'])}
+        if isinstance(m['latlng'], (str, list)) else None), batch)
+
+
+MIGRATIONS = {
+    # Backfills SUGGESTED scores, which are otherwise kept up to date by
+    # Models.UnitOfWork and the delete paths.
+    'suggestions': cypher.rebuild_suggestions,
+    # Event times used to be stored as the strings clients sent.
+    'event_times': event_times,
+    # So were event locations, as 'lat,lng' strings or lists holding one.
+    'event_locations': event_locations,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a data migration.')
+    parser.add_argument('migration', choices=sorted(MIGRATIONS))
+    args = parser.parse_args()
+    MIGRATIONS[args.migration](auth.connect_graph())
+    print('Ran %s.' % args.migration)
+
+
+if __name__ == '__main__':
+    main()
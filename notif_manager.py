@@ -1,53 +1,151 @@
 """
 Deifne methods for sending notifications via FCM.
+
+Notifications are enqueued on a background Dispatcher, so the send_* helpers
+return without waiting on FCM. Recipients of the same title and body are
+batched into multicast sends.
 """
+import json
+
 import auth
-from pyfcm import FCMNotification
+import cypher
+from dispatch import Dispatcher
+from pyfcm.errors import FCMServerError
 from py2neo import Graph
+from requests.exceptions import ConnectionError, ConnectTimeout
+from urllib3.exceptions import NewConnectionError
 from Models import Person, Circle, Event, GraphError
 
-push_service = FCMNotification(api_key=auth.fcm_creds())
+push_service = auth.Lazy(auth.connect_fcm)
 EVENT_NOTIF_TITLE = 'New Event Invite'
 FRIEND_NOTIF_TITLE = 'New Friend'
 CIRCLE_NOTIF_TITLE = 'New Circle'
 
+# FCM accepts at most this many registration IDs per multicast request.
+MAX_MULTICAST = 1000
+# Per-token FCM errors meaning the token will never work again.
+INVALID_TOKEN_ERRORS = ('NotRegistered', 'InvalidRegistration',
+                        'MismatchSenderId')
 
-def send_add_person_notif(graph, adder, people_to_notify):
-    for p in people_to_notify:
-        try:
-            send_notification(p.messaging_token, FRIEND_NOTIF_TITLE,
-                              '{} has added you as a friend!'
-                              .format(adder.display_name))
-        except Exception as x:
-            print('Unable to send notification: ' + str(x))
 
+class FakePushService(object):
+    """Offline stand-in for FCMNotification. Records every send, raises
+    `error` for the first `failures` calls and reports the tokens in
+    `invalid_tokens` as NotRegistered."""
 
-def send_event_notif(graph, c, e, creator_id):
-    for p in list(Circle.members_of(graph, c.__primaryvalue__)):
-        if p.__primaryvalue__ is creator_id:  # don't send notification to creator
+    def __init__(self, failures=0,
+                 error=FCMServerError('FCM server is temporarily unavailable'),
+                 invalid_tokens=()):
+        self.failures = failures
+        self.error = error
+        self.invalid_tokens = set(invalid_tokens)
+        self.sent = []
+
+    def notify_multiple_devices(self, registration_ids=None,
+                                message_title=None, message_body=None,
+                                **kwargs):
+        if self.failures > 0:
+            self.failures -= 1
+            raise self.error
+        results = []
+        for token in registration_ids:
+            if token in self.invalid_tokens:
+                results.append({'error': 'NotRegistered'})
+            else:
+                self.sent.append((token, message_title, message_body))
+                results.append({'message_id': str(len(self.sent))})
+        failures = sum(1 for r in results if 'error' in r)
+        return {'success': len(results) - failures, 'failure': failures,
+                'results': results}
+
+
+def deliver_multicast(graph, recipients, notif_title, notif_body):
+    """Sends one multicast to recipients, a list of (person ID, token) pairs.
+    Runs on the dispatcher's workers. Clears tokens FCM reports as invalid,
+    best effort, and returns {person ID: error} for every recipient that
+    failed."""
+    response = push_service.notify_multiple_devices(
+        registration_ids=[token for _, token in recipients],
+        message_title=notif_title, message_body=notif_body)
+    failed = {}
+    dead = []
+    for (p_id, token), result in zip(recipients, response.get('results', [])):
+        error = result.get('error')
+        if not error:
             continue
+        failed[p_id] = error
+        if error in INVALID_TOKEN_ERRORS:
+            dead.append((p_id, token))
+    if dead:
+        # FCM has already delivered this multicast, so a cleanup failure must
+        # not escape to the dispatcher, which would send it again.
         try:
-            send_notification(p.messaging_token, EVENT_NOTIF_TITLE,
-                              'You\'ve been invited to {} for your Circle called {}. '
-                              'Open the app for more details!'
-                              .format(e.display_name, c.display_name))
+            cypher.clear_messaging_tokens(graph, dead)
         except Exception as x:
-            print('Unable to send notification: ' + str(x))
+            print(json.dumps({'severity': 'ERROR',
+                              'message': 'clearing dead tokens failed',
+                              'error': str(x),
+                              'people': [p_id for p_id, _ in dead]}))
+    if failed:
+        print(json.dumps({'severity': 'WARNING',
+                          'message': 'notification failed',
+                          'title': notif_title, 'failures': failed}))
+    return failed
+
+
+def not_delivered(error):
+    """Whether error means FCM never accepted the multicast, so sending it
+    again cannot push anything twice: FCM answered with a 5xx, or no
+    connection to it was ever made. Errors after the request went out, e.g.
+    read timeouts, and pyfcm's empty-200 FCMServerError are not retried."""
+    if isinstance(error, FCMServerError):
+        return 'temporarily unavailable' in str(error)
+    if isinstance(error, ConnectTimeout):
+        return True
+    if isinstance(error, ConnectionError) and error.args:
+        reason = getattr(error.args[0], 'reason', error.args[0])
+        return isinstance(reason, NewConnectionError)
+    return False
+
+
+dispatcher = Dispatcher(deliver_multicast, retry_if=not_delivered)
+
+
+def send_add_person_notif(graph, adder, people_to_notify):
+    send_multicast(graph, people_to_notify, FRIEND_NOTIF_TITLE,
+                   '{} has added you as a friend!'.format(adder.display_name))
+
+
+def send_event_notif(graph, c, e, creator_id):
+    members = [p for p in Circle.members_of(graph, c.__primaryvalue__)
+               if p.__primaryvalue__ != creator_id]  # don't notify creator
+    send_multicast(graph, members, EVENT_NOTIF_TITLE,
+                   'You\'ve been invited to {} for your Circle called {}. '
+                   'Open the app for more details!'
+                   .format(e.display_name, c.display_name))
 
 
 def send_new_circle_notif(graph, c, creator_id, people_to_notify):
-    for p in people_to_notify:
-        if p.__primaryvalue__ is creator_id:  # don't send notification to creator
-            continue
-        try:
-            send_notification(p.messaging_token, CIRCLE_NOTIF_TITLE,
-                              'You\'ve been added to a new Circle called {}. '
-                              'Open the app for more details!'
-                              .format(c.display_name))
-        except Exception as x:
-            print('Unable to send notification: ' + str(x))
+    people = [p for p in people_to_notify
+              if p.__primaryvalue__ != creator_id]  # don't notify creator
+    send_multicast(graph, people, CIRCLE_NOTIF_TITLE,
+                   'You\'ve been added to a new Circle called {}. '
+                   'Open the app for more details!'.format(c.display_name))
+
+
+def send_multicast(graph, people, notif_title, notif_body):
+    """Enqueues one multicast per MAX_MULTICAST people that have a messaging
+    token. Returns the number of batches enqueued."""
+    recipients = [(p.__primaryvalue__, p.messaging_token) for p in people
+                  if p.messaging_token]
+    batches = 0
+    for i in range(0, len(recipients), MAX_MULTICAST):
+        if dispatcher.submit(graph, recipients[i:i + MAX_MULTICAST],
+                             notif_title, notif_body):
+            batches += 1
+    return batches
 
 
-def send_notification(notif_id, notif_title, notif_body):
-    return push_service.notify_single_device(registration_id=notif_id,
-                                             message_title=notif_title, message_body=notif_body)
+def send_notification(graph, person, notif_title, notif_body):
+    """Enqueues a notification to a single person."""
+    return send_multicast(graph, [person], notif_title, notif_body)
@@ -0,0 +1,46 @@
+"""
+Opaque cursors and page sizes for paged list resources.
+
+A cursor encodes the keyset position of the last item of a page, so the next
+page is an ordered range query rather than an ever-growing SKIP.
+"""
+import base64
+import binascii
+import json
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 500
+
+
+def encode(position):
+    """Encodes a keyset position dict as a URL-safe token."""
+    data = json.dumps(position, separators=(',', ':'), sort_keys=True)
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode(
+        'ascii').rstrip('=')
+
+
+def decode(token):
+    """Returns the position dict in token, or {} if there is no token.
+    Raises ValueError if the token is malformed."""
+    if not token:
+        return {}
+    try:
+        data = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        position = json.loads(data.decode('utf-8'))
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ValueError('Invalid cursor.')
+    if not isinstance(position, dict):
+        raise ValueError('Invalid cursor.')
+    return position
+
+
+def parse_limit(value):
+    """Returns the page size for a limit query parameter, clamped to
+    [1, MAX_LIMIT]. Raises ValueError if it is not an integer."""
+    if value is None:
+        return DEFAULT_LIMIT
+    try:
+        limit = int(value)
+    except ValueError:
+        raise ValueError('limit must be an integer.')
+    return max(1, min(limit, MAX_LIMIT))
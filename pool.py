@@ -0,0 +1,126 @@
+"""
+Bounded access to the Neo4j graph for threaded serving.
+
+py2neo caches Graph instances by connection settings, so all threads share one
+Graph and its connection pool, which auth.connect_graph sizes to `size`.
+GraphPool lets at most `size` requests use that graph at once; the rest wait
+(up to `timeout` seconds) for a slot instead of queueing on the driver, and
+then fail with PoolTimeout. Replacing broken connections is left to py2neo.
+"""
+import functools
+import threading
+from contextlib import contextmanager
+
+
+class PoolTimeout(RuntimeError):
+    pass
+
+
+class GraphPool(object):
+    """Hands out the graph built by factory, which is called once, on first
+    use, to at most size holders at a time."""
+
+    def __init__(self, factory, size=8, timeout=10.0):
+        self.factory = factory
+        self.size = size
+        self.timeout = timeout
+        self._graph = None
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._stats = {'checkouts': 0, 'timeouts': 0, 'in_use': 0}
+
+    def checkout(self):
+        """Takes a slot and returns the graph, waiting for a free slot for at
+        most timeout seconds. Raises PoolTimeout if none frees up."""
+        if not self._slots.acquire(timeout=self.timeout):
+            self._count('timeouts')
+            raise PoolTimeout('No Neo4j connection free after %ss.'
+                              % self.timeout)
+        try:
+            graph = self._shared_graph()
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._stats['checkouts'] += 1
+            self._stats['in_use'] += 1
+        return graph
+
+    def release(self):
+        """Gives back a slot taken by checkout."""
+        with self._lock:
+            self._stats['in_use'] -= 1
+        self._slots.release()
+
+    @contextmanager
+    def session(self):
+        """Yields the graph, holding a slot for the duration of the block."""
+        graph = self.checkout()
+        try:
+            yield graph
+        finally:
+            self.release()
+
+    def _shared_graph(self):
+        if self._graph is None:
+            with self._lock:
+                if self._graph is None:
+                    self._graph = self.factory()
+        return self._graph
+
+    def _count(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, size=self.size)
+
+    """
+    Per-request checkout, driven by Flask hooks in main.
+    """
+
+    def start_request(self):
+        self._local.in_request = True
+        self._local.graph = None
+
+    def finish_request(self):
+        graph = getattr(self._local, 'graph', None)
+        self._local.in_request = False
+        self._local.graph = None
+        if graph is not None:
+            self.release()
+
+    def request_graph(self):
+        """Returns the graph for the current request, taking a slot on first
+        use, or None outside a request."""
+        if not getattr(self._local, 'in_request', False):
+            return None
+        if self._local.graph is None:
+            self._local.graph = self.checkout()
+        return self._local.graph
+
+
+class PooledGraph(object):
+    """Stands in for a py2neo Graph. Inside a request it is the graph the
+    request checked out. Elsewhere, e.g. on notification dispatcher threads,
+    every method call takes a slot just for that call."""
+
+    def __init__(self, pool):
+        self._pool = pool
+
+    def __getattr__(self, name):
+        graph = self._pool.request_graph()
+        if graph is not None:
+            return getattr(graph, name)
+        with self._pool.session() as graph:
+            attr = getattr(graph, name)
+        if not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        def call(*args, **kwargs):
+            with self._pool.session() as graph:
+                return getattr(graph, name)(*args, **kwargs)
+        return call
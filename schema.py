@@ -0,0 +1,59 @@
+"""
+Create the indexes and constraints that the queries in Models and cypher rely
+on. Every step checks what already exists first, so this is safe to run on
+every startup or by hand:
+
+    python schema.py
+"""
+import auth
+
+UNIQUE = 'unique'
+INDEX = 'index'
+
+SCHEMA = [
+    # auth_get_req_user looks the caller up by email on every request.
+    (UNIQUE, 'Person', 'email'),
+    # Distance searches on event locations (a point, see cypher).
+    (INDEX, 'Event', 'latlng'),
+]
+
+
+def _exists(graph, kind, label, key):
+    if kind == UNIQUE:
+        return key in graph.schema.get_uniqueness_constraints(label)
+    return (key,) in graph.schema.get_indexes(label)
+
+
+def _create(graph, kind, label, key):
+    if kind == UNIQUE:
+        graph.schema.create_uniqueness_constraint(label, key)
+    else:
+        graph.schema.create_index(label, key)
+
+
+def ensure_schema(graph):
+    """Creates any missing index or constraint in SCHEMA. Returns a list of
+    (kind, label, key, status) tuples where status is 'exists', 'created' or
+    a failure message."""
+    report = []
+    for kind, label, key in SCHEMA:
+        try:
+            if _exists(graph, kind, label, key):
+                status = 'exists'
+            else:
+                _create(graph, kind, label, key)
+                status = 'created'
+        except Exception as x:
+            status = 'failed: ' + str(x)
+        report.append((kind, label, key, status))
+    return report
+
+
+def main():
+    graph = auth.connect_graph()
+    for kind, label, key, status in ensure_schema(graph):
+        print('{:<7} :{}({}) {}'.format(kind, label, key, status))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+"""
+Dispatcher retries and multicast delivery against FakePushService and the
+bench FakeGraph, without FCM.
+
+    python -m pytest tests
+"""
+import threading
+import unittest
+from unittest import mock
+
+import cypher
+import notif_manager
+from dispatch import Dispatcher
+from bench.fake_graph import FakeGraph
+from pyfcm.errors import AuthenticationError, FCMServerError
+from requests.exceptions import ReadTimeout
+
+
+class Failing(object):
+    """A send that raises error for the first `failures` calls."""
+
+    def __init__(self, failures, error):
+        self.failures = failures
+        self.error = error
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise self.error
+
+
+class DispatcherTest(unittest.TestCase):
+
+    def run_job(self, send, **kwargs):
+        sleeps = []
+        dispatcher = Dispatcher(send, workers=1, sleep=sleeps.append,
+                                **kwargs)
+        self.assertTrue(dispatcher.submit())
+        dispatcher.join()
+        return sleeps
+
+    def test_retries_with_backoff(self):
+        send = Failing(2, RuntimeError('down'))
+        sleeps = self.run_job(send, retries=3, backoff=0.5)
+        self.assertEqual(send.calls, 3)
+        self.assertEqual(sleeps, [0.5, 1.0])
+
+    def test_gives_up_after_retries(self):
+        send = Failing(10, RuntimeError('down'))
+        sleeps = self.run_job(send, retries=2, backoff=1)
+        self.assertEqual(send.calls, 3)
+        self.assertEqual(sleeps, [1, 2])
+
+    def test_retry_if(self):
+        send = Failing(1, ValueError('bad'))
+        sleeps = self.run_job(send, retry_if=lambda x: False)
+        self.assertEqual(send.calls, 1)
+        self.assertEqual(sleeps, [])
+
+    def test_drops_jobs_when_queue_is_full(self):
+        started, release = threading.Event(), threading.Event()
+
+        def send():
+            started.set()
+            release.wait()
+
+        dispatcher = Dispatcher(send, workers=1, max_queue=1)
+        self.assertTrue(dispatcher.submit())
+        started.wait()
+        self.assertTrue(dispatcher.submit())  # waits in the queue
+        self.assertFalse(dispatcher.submit())
+        release.set()
+        dispatcher.join()
+
+
+class NotDeliveredTest(unittest.TestCase):
+
+    def test_retries_only_errors_before_fcm_accepted(self):
+        self.assertTrue(notif_manager.not_delivered(
+            FCMServerError('FCM server is temporarily unavailable')))
+        self.assertFalse(notif_manager.not_delivered(FCMServerError(
+            'FCM server connection error, the response is empty')))
+        self.assertFalse(notif_manager.not_delivered(ReadTimeout()))
+        self.assertFalse(notif_manager.not_delivered(AuthenticationError()))
+
+
+class DeliverMulticastTest(unittest.TestCase):
+
+    def setUp(self):
+        self.graph = FakeGraph()
+        self.people = [self.graph.create_node(
+            'Person', display_name=name, messaging_token=name + '-token')
+            for name in ('a', 'b')]
+        self.recipients = [(p, self.graph.properties(p)['messaging_token'])
+                           for p in self.people]
+        self.push_service = notif_manager.FakePushService(
+            invalid_tokens=['b-token'])
+        patcher = mock.patch.object(notif_manager, 'push_service',
+                                    self.push_service)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def deliver(self):
+        return notif_manager.deliver_multicast(
+            self.graph, self.recipients, 'Title', 'Body')
+
+    def test_clears_invalid_tokens(self):
+        failed = self.deliver()
+
+        self.assertEqual(failed, {self.people[1]: 'NotRegistered'})
+        self.assertEqual(self.push_service.sent,
+                         [('a-token', 'Title', 'Body')])
+        self.assertEqual(
+            self.graph.properties(self.people[0])['messaging_token'],
+            'a-token')
+        self.assertIsNone(
+            self.graph.properties(self.people[1]).get('messaging_token'))
+
+    def test_cleanup_failure_does_not_resend(self):
+        with mock.patch.object(cypher, 'clear_messaging_tokens',
+                               side_effect=RuntimeError('pool timeout')):
+            failed = self.deliver()
+
+        self.assertEqual(failed, {self.people[1]: 'NotRegistered'})
+        self.assertEqual(len(self.push_service.sent), 1)
+
+    def test_fcm_outage_is_retried(self):
+        self.push_service.failures = 1
+        dispatcher = Dispatcher(notif_manager.deliver_multicast, workers=1,
+                                retry_if=notif_manager.not_delivered,
+                                sleep=lambda seconds: None)
+        dispatcher.submit(self.graph, self.recipients, 'Title', 'Body')
+        dispatcher.join()
+
+        self.assertEqual(self.push_service.sent,
+                         [('a-token', 'Title', 'Body')])
+
+
+if __name__ == '__main__':
+    unittest.main()
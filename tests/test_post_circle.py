@@ -0,0 +1,42 @@
+"""
+POST /circles against the bench FakeGraph, with Firebase and FCM stubbed out.
+
+    python -m pytest tests
+"""
+import unittest
+
+import notif_manager
+from bench import synthetic
+from bench.fake_graph import FakeGraph
+from bench.run import API, install, token_for
+
+
+class PostCircleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.graph = FakeGraph()
+        self.world = synthetic.generate(self.graph, people=10, circles=1,
+                                        seed=0)
+        self.app = install(self.graph)
+
+    def test_notifies_members(self):
+        owner, members = self.world.people[0], self.world.people[1:4]
+        response = self.app.test_client().post(
+            '%s/circles' % API,
+            json={'display_name': 'New', 'owner_id': owner,
+                  'People': [owner] + members},
+            headers={'Authorization': token_for(self.graph, owner)})
+        notif_manager.dispatcher.join()
+
+        self.assertEqual(response.status_code, 200)
+        sent = notif_manager.push_service.sent
+        self.assertEqual(
+            sorted(token for token, _, _ in sent),
+            sorted(self.graph.properties(p)['messaging_token']
+                   for p in members))
+        self.assertTrue(all(title == notif_manager.CIRCLE_NOTIF_TITLE
+                            for _, title, _ in sent))
+
+
+if __name__ == '__main__':
+    unittest.main()